@@ -6,16 +6,33 @@ import threading  # Per lavorare con i thread in applicazioni multithread.
 import shutil  # Per operazioni sui file come copiare, spostare ed eliminare file.
 import sys  # Per interagire con il sistema e gestire gli argomenti da riga di comando o terminare il programma.
 import time  # Per operazioni legate al tempo (ad esempio, mettere in pausa il programma, misurare il tempo).
+import queue  # Per le code thread-safe che collegano le fasi della pipeline.
+import subprocess  # Per lanciare FFmpeg direttamente durante la conversione audio.
+import random  # Per il jitter delle attese tra un tentativo e l'altro.
+import sqlite3  # Per la coda di lavori condivisa tra più processi o container.
+import socket  # Per identificare il worker (nome della macchina) nella coda condivisa.
+import hashlib  # Per calcolare l'hash del contenuto dei file audio (archivio centrale e deduplica).
+import json  # Per leggere e scrivere i file di indice e di stato in formato JSON.
+import difflib  # Per confrontare il titolo dei video di YouTube con il nome del brano.
+import itertools  # Per i numeri progressivi dei lavori del demone.
+import urllib.request  # Per inviare lavori al demone dai sottocomandi submit e status.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Per l'API locale del demone.
+import argparse  # Per i sottocomandi della modalità non interattiva (download, update, list, ...).
+import atexit  # Per svuotare la coda delle scritture dei log prima dell'uscita.
+import secrets  # Per il token che autorizza le richieste al demone.
+try:
+    import fcntl  # Lock tra processi sui file (solo Linux/macOS).
+except ImportError:
+    fcntl = None  # Su Windows resta solo il lock tra thread dello stesso processo.
 from pathlib import Path  # Per gestire e manipolare i percorsi dei file in modo più comodo.
+from contextlib import contextmanager  # Per prestare e restituire le istanze di yt-dlp riutilizzabili.
+from collections import OrderedDict  # Per la cache LRU delle ricerche su YouTube.
 from concurrent.futures import ThreadPoolExecutor, as_completed  # Per eseguire operazioni in parallelo usando thread (ThreadPoolExecutor) e gestire i risultati (as_completed).
 
 # Importazioni di Librerie di Terze Parti
-import spotipy  # Per interagire con l'API Web di Spotify, principalmente per ottenere informazioni su tracce e playlist.
-import yt_dlp  # Una libreria per il download di contenuti da YouTube e altre piattaforme.
-from spotipy.oauth2 import SpotifyClientCredentials  # Per gestire l'autenticazione di Spotify usando le credenziali client.
+# spotipy, yt_dlp e mutagen sono pesanti: vengono importate solo dentro le funzioni che le usano,
+# così l'avvio (e comandi come "list" o "--help") resta immediato.
 from dotenv import load_dotenv  # Per caricare variabili d'ambiente da un file .env, utile per memorizzare dati sensibili come le API key.
-from mutagen.easyid3 import EasyID3  # Per leggere e scrivere metadati (tag ID3) nei file MP3.
-from mutagen.mp3 import MP3  # Per lavorare con file MP3 (es. ottenere proprietà come la durata).
 from colorama import Fore, Style  # Per colorare il testo nel terminale e applicare stili (utile per formattare l'output nelle CLI).
 
 
@@ -38,8 +55,16 @@ def create_env_file():
     spotify_client_id = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Enter SPOTIFY_CLIENT_ID: ").strip() #mi assicuro non ci siano spazi indesiderati
     spotify_client_secret = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Enter SPOTIFY_CLIENT_SECRET: ").strip()
     max_threads = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Enter MAX_THREADS: ").strip()
+    # Stesso controllo di settings(): un valore sbagliato finirebbe anche in SEARCH_THREADS e DOWNLOAD_THREADS
+    while not (max_threads.isdigit() and int(max_threads) > 0):
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid MAX_THREADS '{max_threads}', enter a whole number greater than 0.")
+        max_threads = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Enter MAX_THREADS: ").strip()
     preferred_quality = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Enter PREFERRED_QUALITY: ").strip()
     cache_yt = os.path.join(CONFIG_FOLDER, "yt-cache")
+    # Pool separati: ricerche e download (rete) possono essere molti, le conversioni FFmpeg (CPU) quanti i core
+    search_threads = max_threads
+    download_threads = max_threads
+    transcode_threads = os.cpu_count() or 2
 
     #Compila ciò che va scritto nel .env
 
@@ -49,6 +74,10 @@ SPOTIFY_CLIENT_SECRET={spotify_client_secret}
 MAX_THREADS={max_threads}
 PREFERRED_QUALITY={preferred_quality}
 XDG_CACHE_HOME={cache_yt}
+PIPELINE_MODE=1
+SEARCH_THREADS={search_threads}
+DOWNLOAD_THREADS={download_threads}
+TRANSCODE_THREADS={transcode_threads}
 """
     
     with open(ENV_PATH, "w") as f: #crea il .env se manca e lo riempie con ciò di cui ha bisogno per far funzionare il programma 
@@ -58,6 +87,8 @@ XDG_CACHE_HOME={cache_yt}
 #funzione per pulire il terminale, dovrebbe funzionare sia su WIN sia su MACOS
 def clear_terminal():
     """Pulisce il terminale a seconda del sistema operativo."""
+    if headless:
+        return  # in modalità non interattiva l'output va in log o in pipe: niente da pulire
     if os.name == 'nt':
         os.system('cls')
     else:
@@ -67,109 +98,679 @@ def check_ffmpeg():
     if shutil.which("ffmpeg") is None:
         print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"FFmpeg is not installed or not in the PATH.")
         print("Download it from: https://ffmpeg.org/download.html and install it.")
-        input("\nPress Enter to exit...")
-        sys.exit(1)  # Termina l'app con errore
+        if not headless:
+            input("\nPress Enter to exit...")
+        sys.exit(EXIT_CONFIG_ERROR if headless else 1)  # Termina l'app con errore
     else:
         print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"FFmpeg is  installed in the PATH.")
         clear_terminal()
 
-#Controlla se esiste un file .env e si prepara a caricarne le variabili
-ensure_config_directory()
+#Carica la configurazione: se manca il .env lo crea chiedendo i dati (solo in modalità interattiva)
+def load_config(interactive=True):
+    """
+    Si assicura che il .env esista e lo carica. In modalità non interattiva, se manca,
+    stampa un errore e ritorna False invece di chiedere i dati all'utente.
+    """
+    global client_id, client_secret
+    ensure_config_directory()
+    if os.path.exists(ENV_PATH):
+        if interactive:
+            print(f"File .env trovato in {ENV_PATH}. Loading...")
+    elif interactive:
+        create_env_file()
+    else:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{ENV_PATH} not found. Run the program once without arguments to create it.")
+        return False
+    load_dotenv(ENV_PATH, override=True)
+    client_id = os.getenv("SPOTIFY_CLIENT_ID")
+    client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
+    apply_thread_settings()  # al primo avvio i valori sono stati letti prima che il .env esistesse
+    if interactive:
+        print("Configurazione caricata.")
+        clear_terminal()
+    return True
+
+#Lettura dei valori numerici del .env: un valore sbagliato non deve bloccare il programma
+def env_int(name, default, current=None, minimum=1):
+    """
+    Legge un intero (almeno minimum) da os.environ: se manca vale default; se non è valido (vuoto, testo,
+    troppo piccolo) stampa un avviso e tiene il valore attuale, così un errore nel .env non blocca il programma.
+    """
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default if current is None else current
+    try:
+        number = int(value)
+        if number < minimum:
+            raise ValueError
+        return number
+    except ValueError:
+        fallback = default if current is None else current
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid {name} '{value}', keeping {fallback}.")
+        return fallback
+
+def env_float(name, default):
+    """Come env_int, per i numeri decimali maggiori di zero (secondi, giorni, richieste al secondo)."""
+    value = os.getenv(name, "").strip()
+    if not value:
+        return default
+    try:
+        number = float(value)
+        if not number > 0:
+            raise ValueError
+        return number
+    except ValueError:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid {name} '{value}', keeping {default}.")
+        return default
+
+# All'import si leggono solo i valori già presenti: nessuna domanda e nessuna pulizia del terminale
+headless = False  # True quando il programma è avviato con un sottocomando
 if os.path.exists(ENV_PATH):
-    print(f"File .env trovato in {ENV_PATH}. Loading...")
-else:
-    create_env_file()
-# Carica le variabili d'ambiente dal file .env
-load_dotenv(ENV_PATH, override=True)
+    load_dotenv(ENV_PATH, override=True)
 client_id = os.getenv("SPOTIFY_CLIENT_ID")
 client_secret = os.getenv("SPOTIFY_CLIENT_SECRET")
-max_threads = int(os.getenv("MAX_THREADS", "4"))
-print("Configurazione caricata.")
-clear_terminal()
+max_threads = env_int("MAX_THREADS", 4)
+pipeline_mode = os.getenv("PIPELINE_MODE", "1") == "1"  # 1 = pipeline per traccia, 0 = fasi separate
+pipeline_queue_size = env_int("PIPELINE_QUEUE_SIZE", max_threads * 2)
+shared_update = os.getenv("SHARED_UPDATE", "1") == "1"  # 1 = "update" senza numero usa lo scheduler condiviso
+# MAX_THREADS indica quante tracce sono in lavorazione insieme; ogni risorsa ha poi il suo limite
+search_threads = env_int("SEARCH_THREADS", max_threads)  # ricerche su YouTube (rete)
+download_threads = env_int("DOWNLOAD_THREADS", max_threads)  # download con yt-dlp (rete)
+transcode_threads = env_int("TRANSCODE_THREADS", os.cpu_count() or 2)  # conversioni FFmpeg (CPU)
 
 #---INIZIO CODICE VECCHIO---               Questa parte del codice forza l'utilizzo del file mp3 in quanto ci sono dei problemi nell'implementare altri tipi di file.
 codec = "mp3" #Il supporto a codec diversi non è al momento dispobile
 codec = '.' + codec if not codec.startswith('.') else codec  # Aggiungiamo il punto se manca
 #---FINE CODICE VECCHIO--- 
-
-#set dati file scaricati, una sorta di database delle playlist scaricate
-DATA_FILE = os.path.join(CONFIG_FOLDER, "data.dat")
+# AUDIO_FORMAT=passthrough mantiene il flusso scaricato (m4a/opus) con un semplice remux, senza ricodifica in MP3
+audio_format = os.getenv("AUDIO_FORMAT", "mp3").strip().lower()
+if audio_format not in ("mp3", "passthrough"):
+    audio_format = "mp3"
+# Estensioni dei file audio gestiti (indice, verifica, dedup): in una cartella possono convivere formati diversi
+AUDIO_EXTENSIONS = (".mp3", ".m4a", ".opus", ".ogg")
+# Contenitore del flusso scaricato -> estensione del file dopo il remux (il codec audio resta quello originale)
+PASSTHROUGH_EXTENSIONS = {".webm": ".opus", ".opus": ".opus", ".ogg": ".ogg", ".m4a": ".m4a", ".mp4": ".m4a", ".mp3": ".mp3"}
+
+#Libreria SQLite: playlist salvate, brani, file scaricati, ID di YouTube e stato delle sincronizzazioni
+LIBRARY_DB = os.path.join(CONFIG_FOLDER, "library.db")
+DATA_FILE = os.path.join(CONFIG_FOLDER, "data.dat")  # vecchio elenco di testo, importato nella libreria e rinominato in .bak
+library_local = threading.local()  # una connessione per thread
+library_lock = threading.Lock()
+library_ready = False  # tabelle create e vecchi file importati in questo processo
+playlist_names = {}  # ID playlist -> nome, ricordato quando la lista dei brani viene scaricata
 
 # Lock per operazioni critiche sui file
 file_lock = threading.Lock()
+# Errori registrati con log_error in questa esecuzione (determinano il codice di uscita dei sottocomandi)
+error_count = 0
+error_count_lock = threading.Lock()
+# Codici di uscita della modalità non interattiva
+EXIT_OK = 0
+EXIT_FAILURES = 1  # il comando è terminato ma alcune tracce hanno dato errore (vedi log.txt)
+EXIT_USAGE = 2  # argomenti non validi (stesso codice usato da argparse)
+EXIT_CONFIG_ERROR = 3  # .env o FFmpeg mancanti
 # Set globale per tracce in elaborazione (chiave: (titolo, artista) in lowercase)
 in_processing = set()
+in_processing_lock = threading.Lock()
+
+#Indice dei file finali per cartella (nome file, mtime, dimensione, titolo, artista)
+INDEX_FILE_NAME = ".spotifydl_index.json"
+INDEX_VERSION = 2
+index_lock = threading.Lock()
+folder_indexes = {}  # cartella assoluta -> indice in memoria
+
+#Slot disponibili per ogni risorsa: limitano le operazioni contemporanee indipendentemente da MAX_THREADS
+search_slots = threading.BoundedSemaphore(search_threads)
+download_slots = threading.BoundedSemaphore(download_threads)
+transcode_slots = threading.BoundedSemaphore(transcode_threads)
+
+#Cache delle ricerche su YouTube (chiave -> URL scelto), in ordine di utilizzo per l'eviction LRU
+SEARCH_CACHE_FILE = os.path.join(CONFIG_FOLDER, "search_cache.json")
+SEARCH_CACHE_TTL = env_float("SEARCH_CACHE_TTL_DAYS", 30) * 86400
+SEARCH_CACHE_NEGATIVE_TTL = env_float("SEARCH_CACHE_NEGATIVE_TTL_HOURS", 24) * 3600
+SEARCH_CACHE_MAX_ENTRIES = env_int("SEARCH_CACHE_MAX_ENTRIES", 50000)
+search_cache_lock = threading.Lock()
+search_cache = None  # caricata al primo utilizzo
+search_cache_dirty = False
+
+#Scelta del risultato di YouTube: oltre questa differenza di durata (o il 10% del brano, se maggiore) il video viene scartato
+MATCH_MAX_DURATION_DELTA = env_float("MATCH_MAX_DURATION_DELTA", 30)  # secondi
+MATCH_UNWANTED_WORDS = ("live", "cover", "karaoke", "remix", "loop", "hour", "hours", "reaction", "instrumental",
+                        "sped up", "slowed", "nightcore", "8d")  # penalizzate se non sono nel titolo di Spotify
+MATCH_SCORING_VERSION = 2  # fa parte della chiave della cache delle ricerche: va aumentata quando cambia score_candidate
+
+#Istanze yt_dlp.YoutubeDL libere, riutilizzate da un thread all'altro, con la generazione delle opzioni
+#con cui sono state create: quelle di una generazione vecchia vengono scartate quando tornano nel pool
+ydl_pools = {"search": queue.LifoQueue(), "download": queue.LifoQueue()}
+ydl_generations = {"search": 0, "download": 0}
+
+#Client Spotify condiviso e numero massimo di richieste parallele per i metadati delle playlist
+SPOTIFY_TOKEN_CACHE = os.path.join(CONFIG_FOLDER, ".spotify_token")
+spotify_fanout = env_int("SPOTIFY_FANOUT", 8)
+spotify_client_lock = threading.Lock()
+spotify_client = None  # creato al primo utilizzo da get_spotify_client()
+
+#Vecchio file dello stato delle sincronizzazioni: ora lo stato è nella libreria, il file viene solo importato
+SYNC_STATE_FILE = os.path.join(CONFIG_FOLDER, "sync_state.json")
+
+#Paginazione delle playlist: solo i campi dei brani effettivamente usati
+PLAYLIST_PAGE_SIZE = 100
+PLAYLIST_ITEM_FIELDS = "total,items(track(id,name,track_number,duration_ms,external_ids(isrc),artists(name),album(name,release_date)))"
+
+#Archivio centrale opzionale (vuoto = disattivato): i brani sono salvati una volta e collegati nelle cartelle
+track_store = os.path.expanduser(os.getenv("TRACK_STORE", "").strip())
+STORE_HASH_CHUNK = 1024 * 1024
+store_lock = threading.Lock()
+
+#Verifica incrementale: file toccati in questa esecuzione ed elenco persistente dei file non validi
+BAD_FILES_NAME = ".spotifydl_bad_files.json"
+touched_lock = threading.Lock()
+touched_files = {}  # cartella assoluta -> percorsi prodotti o modificati in questa esecuzione
+
+#Politica per i file che non sono più nella playlist: keep (default), delete o trash
+sync_policy = os.getenv("SYNC_POLICY", "keep").strip().lower()
+if sync_policy not in ("keep", "delete", "trash"):
+    sync_policy = "keep"
+TRASH_FOLDER_NAME = ".trash"
+
+#Controllo adattivo delle richieste: richieste al secondo e tentativi in caso di rate limit
+RATE_MAX_RETRIES = env_int("RATE_MAX_RETRIES", 5, minimum=0)
+RATE_BACKOFF_BASE = 1.0
+RATE_BACKOFF_CAP = 60.0
+rate_states = {}  # servizio -> stato del controllo, riempito dopo la definizione di _new_rate_state
+
+#Giornale delle tracce in lavorazione, per riprendere le esecuzioni interrotte
+JOURNAL_FILE_NAME = ".spotifydl_journal.jsonl"
+TEMP_FILE_PATTERN = re.compile(r"^([0-9a-f]{32})(\..+)?$")  # nomi generati con uuid4().hex
+journal_lock = threading.Lock()
+journals = {}  # cartella assoluta -> {chiave traccia: ultimo stato}
+JOURNAL_CLOSED_STAGES = ("renamed", "failed")  # voci chiuse: spariscono alla compattazione e non riservano temporanei
+#Ogni esecuzione attiva su una cartella tiene un lock condiviso: i temporanei orfani si eliminano solo in esclusiva
+ACTIVITY_LOCK_NAME = ".spotifydl_active.lock"
+STALE_TEMP_SECONDS = 3600  # senza fcntl (Windows) si eliminano solo i temporanei fermi da almeno un'ora
+activity_locks = {}  # cartella assoluta -> file di lock aperti da questo processo (uno per esecuzione)
+
+#Coda condivisa tra processi: file SQLite nella cartella, lease rinnovate dal heartbeat e lock per le rinomine
+QUEUE_DB_NAME = ".spotifydl_queue.db"
+FOLDER_LOCK_NAME = ".spotifydl.lock"
+QUEUE_LEASE_SECONDS = env_float("QUEUE_LEASE_SECONDS", 120)
+QUEUE_POLL_SECONDS = 5
+QUEUE_MAX_ATTEMPTS = 3
+worker_processes = env_int("WORKER_PROCESSES", os.cpu_count() or 2)
+
+#Demone locale: porta dell'API, lavori eseguiti in parallelo e registro dei lavori
+daemon_port = env_int("DAEMON_PORT", 8765)
+daemon_concurrent_jobs = env_int("DAEMON_CONCURRENT_JOBS", 1)
+DAEMON_TOKEN_FILE = os.path.join(CONFIG_FOLDER, ".daemon_token")  # leggibile solo dall'utente: chi lo legge può inviare lavori
+daemon_queue = queue.PriorityQueue()
+daemon_jobs = {}  # id -> record del lavoro
+daemon_lock = threading.Lock()
+daemon_ids = itertools.count(1)
+
+#Scritture di log.txt: un solo thread le esegue, gli altri le mettono in coda
+write_queue = queue.Queue()
+writer_thread = None
+writer_lock = threading.Lock()
+
+#Archivio dei brani falliti per cartella, con attesa minima prima di riprovarli in base alla causa
+FAILURES_FILE_NAME = ".spotifydl_failures.json"
+RETRY_BACKOFF = {  # secondi di attesa dopo il primo fallimento, raddoppiati ad ogni tentativo
+    "not_found": SEARCH_CACHE_NEGATIVE_TTL,  # prima di allora la ricerca risponderebbe dalla cache negativa
+    "download": 600.0,
+    "transcode": 60.0,
+    "rename": 60.0,
+}
+RETRY_BACKOFF_CAP = 7 * 86400
+failures_lock = threading.Lock()  # tra i thread; tra i processi si usa il lock sul file (path_lock)
+
+#Segnale di fine per le code della pipeline e numero di thread dedicati ai metadati
+_PIPELINE_DONE = object()
+PIPELINE_TAG_WORKERS = 2
+
+#Metriche di esecuzione: contatori e istogrammi di latenza per fase, esportati in JSON e per il textfile collector di Prometheus
+METRICS_FILE = os.path.expanduser(os.getenv("METRICS_FILE", os.path.join(CONFIG_FOLDER, "metrics.json")).strip())
+METRICS_TEXTFILE = os.path.expanduser(os.getenv("METRICS_TEXTFILE", "").strip())  # es. /var/lib/node_exporter/textfile/spotifydl.prom
+METRIC_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # limiti superiori in secondi
+metrics_lock = threading.Lock()
+metrics = {"started": time.time(), "stages": {}, "failures": {}, "counters": {}}
 
 
 
 #è la funzione che ha il compito di scrivere i log sui file, è scritta in questo modo per proteggersi da eventuali problemi di accessi di più threads al file contemporaneamente
 def log_error(message, output_folder):
-    """Scrive un messaggio di errore nel file log.txt nella cartella di output."""
+    """Accoda un messaggio di errore per il file log.txt nella cartella di output (lo scrive il thread di scrittura)."""
+    global error_count
     log_file = os.path.join(output_folder, "log.txt")
     timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(f"[{timestamp}] {message}\n")
+    queue_write("append", log_file, f"[{timestamp}] {message}\n")
+    with error_count_lock:
+        error_count += 1  # usato dai sottocomandi per il codice di uscita
+
+#Thread di scrittura: i worker non aspettano mai il disco per registrare un errore
+def queue_write(kind, path, content=None):
+    """
+    Accoda una scrittura: "append" aggiunge content in fondo al file, "replace" lo sostituisce
+    in modo atomico, "remove" elimina il file. Il thread di scrittura parte al primo utilizzo.
+    """
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=_writer_loop, daemon=True)
+            writer_thread.start()
+    write_queue.put((kind, path, content))
+
+def _writer_loop():
+    """Prende dalla coda tutte le scritture pronte e le esegue insieme: ogni file viene aperto una sola volta."""
+    while True:
+        batch = [write_queue.get()]
+        while True:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+        appends = {}
+        replaces = {}  # per ogni file conta solo l'ultima versione accodata
+        for kind, path, content in batch:
+            if kind == "append":
+                appends.setdefault(path, []).append(content)
+            else:
+                replaces[path] = (kind, content)
+        for path, lines in appends.items():
+            try:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.writelines(lines)
+            except OSError as e:
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Cannot write {path}: {e}")
+        for path, (kind, content) in replaces.items():
+            try:
+                if kind == "remove":
+                    if os.path.exists(path):
+                        os.remove(path)
+                else:
+                    with open(path + ".tmp", "w", encoding="utf-8") as f:
+                        f.write(content)
+                    os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Cannot write {path}: {e}")
+        for _ in batch:
+            write_queue.task_done()
+
+def flush_writes():
+    """Attende che tutte le scritture accodate siano su disco (es. prima di leggere log.txt o di uscire)."""
+    if writer_thread is not None:
+        write_queue.join()
+
+atexit.register(flush_writes)
+
+#Raccolta delle metriche: i valori sono cumulativi dall'avvio del processo (come i counter di Prometheus)
+def observe_stage(stage, seconds, ok=True, nbytes=0):
+    """Registra una esecuzione della fase stage: durata, esito e byte elaborati."""
+    with metrics_lock:
+        entry = metrics["stages"].setdefault(stage, {"count": 0, "failures": 0, "seconds": 0.0, "bytes": 0,
+                                                     "buckets": [0] * len(METRIC_BUCKETS)})
+        entry["count"] += 1
+        entry["seconds"] += seconds
+        entry["bytes"] += nbytes
+        if not ok:
+            entry["failures"] += 1
+        for i, bound in enumerate(METRIC_BUCKETS):
+            if seconds <= bound:
+                entry["buckets"][i] += 1  # i bucket sono cumulativi, come li vuole Prometheus
+
+def record_failure(cause):
+    """Conta un brano fallito per la causa indicata (es. not_found, download, transcode)."""
+    with metrics_lock:
+        metrics["failures"][cause] = metrics["failures"].get(cause, 0) + 1
+
+def count_metric(name, amount=1):
+    """Incrementa un contatore generico (brani completati, saltati, risultati dalla cache...)."""
+    with metrics_lock:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + amount
+
+def reset_metrics():
+    """Azzera tutte le metriche e fa ripartire il conteggio del tempo (es. tra due misure del benchmark)."""
+    with metrics_lock:
+        metrics.update(started=time.time(), stages={}, failures={}, counters={})
+
+def metrics_summary():
+    """Restituisce il riepilogo delle metriche con tempo trascorso, brani al secondo e byte al secondo."""
+    with metrics_lock:
+        elapsed = max(time.time() - metrics["started"], 1e-9)
+        stages = {stage: {**entry, "buckets": dict(zip(map(str, METRIC_BUCKETS), entry["buckets"])),
+                          "avg_seconds": entry["seconds"] / entry["count"] if entry["count"] else 0.0}
+                  for stage, entry in metrics["stages"].items()}
+        counters = dict(metrics["counters"])
+        failures = dict(metrics["failures"])
+    downloaded = stages.get("download", {}).get("bytes", 0)
+    return {
+        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "elapsed_seconds": elapsed,
+        "tracks_per_second": counters.get("tracks_completed", 0) / elapsed,
+        "bytes_per_second": downloaded / elapsed,
+        "counters": counters,
+        "failures": failures,
+        "stages": stages,
+    }
+
+def _prometheus_text(summary):
+    """Formatta il riepilogo nel formato testuale di Prometheus."""
+    lines = [
+        "# HELP spotifydl_stage_duration_seconds Time spent in each stage of a download.",
+        "# TYPE spotifydl_stage_duration_seconds histogram",
+    ]
+    for stage, entry in sorted(summary["stages"].items()):
+        for bound, count in entry["buckets"].items():
+            lines.append(f'spotifydl_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'spotifydl_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {entry["count"]}')
+        lines.append(f'spotifydl_stage_duration_seconds_sum{{stage="{stage}"}} {entry["seconds"]:.6f}')
+        lines.append(f'spotifydl_stage_duration_seconds_count{{stage="{stage}"}} {entry["count"]}')
+    lines += ["# HELP spotifydl_stage_failures_total Failed executions of each stage.",
+              "# TYPE spotifydl_stage_failures_total counter"]
+    lines += [f'spotifydl_stage_failures_total{{stage="{stage}"}} {entry["failures"]}' for stage, entry in sorted(summary["stages"].items())]
+    lines += ["# HELP spotifydl_stage_bytes_total Bytes handled by each stage.",
+              "# TYPE spotifydl_stage_bytes_total counter"]
+    lines += [f'spotifydl_stage_bytes_total{{stage="{stage}"}} {entry["bytes"]}' for stage, entry in sorted(summary["stages"].items())]
+    lines += ["# HELP spotifydl_track_failures_total Tracks that failed, by cause.",
+              "# TYPE spotifydl_track_failures_total counter"]
+    lines += [f'spotifydl_track_failures_total{{cause="{cause}"}} {count}' for cause, count in sorted(summary["failures"].items())]
+    lines += ["# HELP spotifydl_events_total Track outcomes and cache events.",
+              "# TYPE spotifydl_events_total counter"]
+    lines += [f'spotifydl_events_total{{event="{name}"}} {count}' for name, count in sorted(summary["counters"].items())]
+    lines += ["# HELP spotifydl_tracks_per_second Completed tracks per second since the process started.",
+              "# TYPE spotifydl_tracks_per_second gauge",
+              f"spotifydl_tracks_per_second {summary['tracks_per_second']:.6f}",
+              "# HELP spotifydl_download_bytes_per_second Downloaded bytes per second since the process started.",
+              "# TYPE spotifydl_download_bytes_per_second gauge",
+              f"spotifydl_download_bytes_per_second {summary['bytes_per_second']:.3f}",
+              "# HELP spotifydl_last_run_timestamp_seconds When the metrics were last written.",
+              "# TYPE spotifydl_last_run_timestamp_seconds gauge",
+              f"spotifydl_last_run_timestamp_seconds {time.time():.0f}"]
+    return "\n".join(lines) + "\n"
+
+def write_metrics():
+    """
+    Scrive il riepilogo JSON in METRICS_FILE e, se METRICS_TEXTFILE è impostato, il file .prom per
+    il textfile collector del node exporter. Le scritture sono atomiche (file temporaneo + os.replace),
+    così il node exporter non legge mai un file a metà.
+    """
+    summary = metrics_summary()
+    outputs = [(METRICS_FILE, json.dumps(summary, indent=2, ensure_ascii=False))]
+    if METRICS_TEXTFILE:
+        outputs.append((METRICS_TEXTFILE, _prometheus_text(summary)))
+    for path, content in outputs:
+        if not path:
+            continue
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error writing metrics to {path}: {e}")
+    return summary
+
+#Controllo adattivo delle richieste verso Spotify e YouTube: token bucket, backoff con jitter e limite AIMD
+def _new_rate_state(rate, limit):
+    return {
+        "cond": threading.Condition(),
+        "rate": max(0.1, rate),  # richieste al secondo concesse dal token bucket
+        "tokens": max(1.0, rate),
+        "refilled": time.monotonic(),
+        "limit": float(limit),   # richieste contemporanee consentite in questo momento (AIMD)
+        "max_limit": limit,      # tetto massimo, modificabile a runtime
+        "in_flight": 0,
+        "paused_until": 0.0,     # durante un Retry-After nessuno parte
+    }
+
+def _refill_tokens(state, now):
+    state["tokens"] = min(max(1.0, state["rate"]), state["tokens"] + (now - state["refilled"]) * state["rate"])
+    state["refilled"] = now
+
+@contextmanager
+def rate_limited(service):
+    """Occupa uno slot del servizio: attende il token bucket, il limite di concorrenza e le pause."""
+    state = rate_states[service]
+    with state["cond"]:
+        while True:
+            now = time.monotonic()
+            _refill_tokens(state, now)
+            if now < state["paused_until"]:
+                wait = state["paused_until"] - now
+            elif state["in_flight"] >= max(1, int(state["limit"])):
+                wait = None  # si libera quando un'altra richiesta termina
+            elif state["tokens"] < 1:
+                wait = (1 - state["tokens"]) / state["rate"]
+            else:
+                break
+            state["cond"].wait(wait)
+        state["in_flight"] += 1
+        state["tokens"] -= 1
+    try:
+        yield
+    finally:
+        with state["cond"]:
+            state["in_flight"] -= 1
+            state["cond"].notify_all()
+
+def report_success(service):
+    """Aumento additivo: circa uno slot in più ogni 'limit' richieste andate a buon fine."""
+    state = rate_states[service]
+    with state["cond"]:
+        state["limit"] = min(state["max_limit"], state["limit"] + 1 / max(1.0, state["limit"]))
+        state["cond"].notify_all()
+
+def report_throttle(service, retry_after=None):
+    """Diminuzione moltiplicativa: dimezza la concorrenza e, se il server lo chiede, mette in pausa tutti."""
+    state = rate_states[service]
+    with state["cond"]:
+        state["limit"] = max(1.0, state["limit"] / 2)
+        if retry_after:
+            state["paused_until"] = max(state["paused_until"], time.monotonic() + retry_after)
+    print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{service} is rate limiting, concurrency lowered to {max(1, int(state['limit']))}.")
+
+def set_rate_limit(service, max_limit):
+    """Cambia a runtime il numero massimo di richieste contemporanee di un servizio."""
+    state = rate_states[service]
+    with state["cond"]:
+        state["max_limit"] = max(1, max_limit)
+        state["limit"] = min(state["limit"], state["max_limit"])
+        state["cond"].notify_all()
+
+def rate_limit_info(error):
+    """
+    Riconosce gli errori di rate limit (429 o "Too Many Requests") e ritorna (True, retry_after in secondi o None).
+    Un 403 di YouTube di solito è una firma scaduta o un formato non disponibile: riprovarlo non serve.
+    """
+    status = getattr(error, "http_status", None)
+    headers = getattr(error, "headers", None) or {}
+    if status is None:
+        match = re.search(r"HTTP Error (\d{3})", str(error))
+        status = int(match.group(1)) if match else None
+    if status != 429 and "Too Many Requests" not in str(error):
+        return False, None
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return True, float(retry_after) if retry_after is not None else None
+    except ValueError:
+        return True, None
+
+def call_with_backoff(service, func, *args, **kwargs):
+    """
+    Esegue func rispettando il controllo del servizio. Se la risposta è un rate limit riprova
+    con backoff esponenziale e jitter (o dopo Retry-After); gli altri errori vengono rilanciati.
+    """
+    for attempt in range(RATE_MAX_RETRIES + 1):
+        with rate_limited(service):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                limited, retry_after = rate_limit_info(e)
+                if not limited or attempt == RATE_MAX_RETRIES:
+                    raise
+                report_throttle(service, retry_after)
+            else:
+                report_success(service)
+                return result
+        # L'attesa avviene fuori dallo slot, così non blocca le altre richieste
+        time.sleep(retry_after or random.uniform(0, min(RATE_BACKOFF_CAP, RATE_BACKOFF_BASE * 2 ** attempt)))
+
+def apply_thread_settings():
+    """Rilegge da os.environ i valori dei thread e li applica senza riavviare il programma."""
+    global max_threads, search_threads, download_threads, transcode_threads, spotify_fanout
+    global search_slots, download_slots, transcode_slots, pipeline_queue_size
+    max_threads = env_int("MAX_THREADS", 4, max_threads)
+    search_threads = env_int("SEARCH_THREADS", max_threads)
+    download_threads = env_int("DOWNLOAD_THREADS", max_threads)
+    transcode_threads = env_int("TRANSCODE_THREADS", os.cpu_count() or 2)
+    spotify_fanout = env_int("SPOTIFY_FANOUT", 8, spotify_fanout)
+    pipeline_queue_size = env_int("PIPELINE_QUEUE_SIZE", max_threads * 2)
+    # I thread già in attesa restano sui vecchi semafori; le nuove operazioni usano quelli nuovi
+    search_slots = threading.BoundedSemaphore(search_threads)
+    download_slots = threading.BoundedSemaphore(download_threads)
+    transcode_slots = threading.BoundedSemaphore(transcode_threads)
+    set_rate_limit("spotify", spotify_fanout)
+    set_rate_limit("youtube", search_threads + download_threads)
+    apply_download_settings()
+
+rate_states["spotify"] = _new_rate_state(env_float("SPOTIFY_RATE", 10), spotify_fanout)
+rate_states["youtube"] = _new_rate_state(env_float("YOUTUBE_RATE", 5), search_threads + download_threads)
+
+#Client Spotify condiviso da tutto il processo: un solo token (salvato su disco) e connessioni riutilizzate
+def get_spotify_client():
+    """Restituisce il client Spotify del processo, creandolo al primo utilizzo."""
+    global spotify_client
+    with spotify_client_lock:
+        if spotify_client is None:
+            import spotipy
+            import requests  # dipendenza di spotipy
+            from requests.adapters import HTTPAdapter
+            from spotipy.oauth2 import SpotifyClientCredentials
+            from spotipy.cache_handler import CacheFileHandler
+            auth_manager = SpotifyClientCredentials(
+                client_id=os.getenv("SPOTIFY_CLIENT_ID", client_id),  # settings() aggiorna solo os.environ
+                client_secret=os.getenv("SPOTIFY_CLIENT_SECRET", client_secret),
+                cache_handler=CacheFileHandler(cache_path=SPOTIFY_TOKEN_CACHE),
+            )
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(spotify_fanout, max_threads))
+            session.mount("https://", adapter)
+            spotify_client = spotipy.Spotify(auth_manager=auth_manager, requests_session=session)
+        return spotify_client
+
+def reset_spotify_client():
+    """Scarta il client condiviso e il token salvato (es. dopo aver cambiato le credenziali)."""
+    global spotify_client
+    with spotify_client_lock:
+        spotify_client = None
+        if os.path.exists(SPOTIFY_TOKEN_CACHE):
+            os.remove(SPOTIFY_TOKEN_CACHE)
+
+def fetch_playlists_info(playlist_ids, fields):
+    """
+    Richiede le informazioni di più playlist in parallelo (al massimo SPOTIFY_FANOUT richieste insieme).
+    Restituisce una lista nello stesso ordine degli ID: None solo per le playlist che Spotify dice
+    inesistenti (404, o 400 per un ID non valido); un dict vuoto se la richiesta è fallita per altri
+    motivi (rete, errori del server), perché in quel caso non si sa se la playlist esiste ancora.
+    """
+    sp = get_spotify_client()
+
+    def fetch(playlist_id):
+        try:
+            return call_with_backoff("spotify", sp.playlist, playlist_id, fields=fields)
+        except Exception as e:
+            if getattr(e, "http_status", None) in (400, 404):
+                return None
+            return {}
+
+    if not playlist_ids:
+        return []
+    with ThreadPoolExecutor(min(spotify_fanout, len(playlist_ids))) as executor:
+        return list(executor.map(fetch, playlist_ids))
 
 #Funzione che si occupa di prendere le informazioni della playlist
-def get_spotify_playlist_tracks(playlist_url, caller):
-    """Ottiene la lista dei brani da una playlist di Spotify."""
-    auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+def get_spotify_playlist_tracks(playlist_url, caller, in_worker=False):
+    """
+    Ottiene la lista dei brani da una playlist di Spotify.
+    Con in_worker=True (chiamata da un thread di un pool) le pagine vengono lette in sequenza,
+    senza aprire un altro pool dentro il pool, e il terminale non viene pulito.
+    """
+    sp = get_spotify_client()
 
     if "playlist" in playlist_url:
         playlist_id = playlist_url.split("/")[-1].split("?")[0]
     else:
         raise ValueError("Invalid playlist URL")
 
-    tracks = []
-    offset = 0
-    playlist_info = sp.playlist(playlist_id)
+    playlist_info = call_with_backoff("spotify", sp.playlist, playlist_id, fields="name")
     playlist_name = playlist_info['name']
+    playlist_names[playlist_id] = playlist_name  # save_entry lo salva nella libreria senza richiederlo di nuovo
 
-    clear_terminal()
+    if not in_worker:
+        clear_terminal()
     if caller == 1:
         print(Fore.GREEN + Style.BRIGHT + f"You're downloading from: {playlist_name}" + Style.RESET_ALL)
 
-    while True:
-        results = sp.playlist_tracks(playlist_id, offset=offset)
-        for item in results['items']:
+    def fetch_page(offset):
+        started = time.monotonic()
+        try:
+            page = call_with_backoff("spotify", sp.playlist_items, playlist_id, fields=PLAYLIST_ITEM_FIELDS,
+                                     limit=PLAYLIST_PAGE_SIZE, offset=offset, additional_types=("track",))
+        except Exception:
+            observe_stage("spotify", time.monotonic() - started, ok=False)
+            raise
+        observe_stage("spotify", time.monotonic() - started)
+        return page
+
+    # La prima pagina dice quanti brani ci sono: le altre vengono richieste in parallelo
+    first_page = fetch_page(0)
+    total = first_page.get('total') or 0
+    offsets = range(PLAYLIST_PAGE_SIZE, total, PLAYLIST_PAGE_SIZE)
+    pages = [first_page]
+    if offsets and in_worker:
+        pages.extend(fetch_page(offset) for offset in offsets)
+    elif offsets:
+        with ThreadPoolExecutor(min(spotify_fanout, len(offsets))) as executor:
+            pages.extend(executor.map(fetch_page, offsets))  # map mantiene l'ordine delle pagine
+
+    tracks = []
+    for page in pages:
+        for item in page['items']:
             track = item['track']
             if track:
                 name = track.get('name', 'Unknown Track')
                 artists = ', '.join([artist.get('name', 'Unknown Artist') for artist in track.get('artists', [])])
-                album = track.get('album', {}).get('name', 'Unknown Album')
+                album = (track.get('album') or {}).get('name', 'Unknown Album')
                 track_number = track.get('track_number', None)
-                release_date = track['album'].get('release_date', 'Unknown Year')
+                release_date = (track.get('album') or {}).get('release_date') or 'Unknown Year'
                 year = release_date.split("-")[0]
                 tracks.append({
+                    'id': track.get('id'),
                     'name': name,
                     'artists': artists,
                     'album': album,
                     'track_number': track_number,
-                    'year': year  
+                    'year': year,
+                    'duration_ms': track.get('duration_ms'),
+                    'isrc': (track.get('external_ids') or {}).get('isrc'),
                 })
             else:
                 if caller == 1:
                     print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Track is None, skipping...")
 
-        if len(results['items']) < 100:
-            break
-        offset += 100
-
     return tracks
 
 #Funzione che si occupa di prendere le informazioni degli album
 def get_spotify_album_tracks(album_url):
     """Ottiene la lista dei brani da un album di Spotify."""
-    auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    sp = get_spotify_client()
 
     if "album" in album_url:
         album_id = album_url.split("/")[-1].split("?")[0]
     else:
         raise ValueError("Invalid album URL")
 
-    album_info = sp.album(album_id)
+    album_info = call_with_backoff("spotify", sp.album, album_id)
     album_name = album_info.get('name', 'Unknown Album')
 
     clear_terminal()
@@ -183,26 +784,28 @@ def get_spotify_album_tracks(album_url):
         release_date = album_info.get('release_date', 'Unknown Year')
         year = release_date.split("-")[0]
         tracks.append({
+            'id': track.get('id'),
             'name': name,
             'artists': artists,
             'album': album_name,
             'track_number': track_number,
-            'year': year  
+            'year': year,
+            'duration_ms': track.get('duration_ms'),
+            'isrc': None,  # i brani di un album non includono external_ids
         })
     return tracks
 
 #Funzione che si occupa di prendere le informazioni di una singola traccia
 def get_spotify_single_track(track_url):
     """Ottiene le informazioni di un singolo brano di Spotify."""
-    auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-    sp = spotipy.Spotify(auth_manager=auth_manager)
+    sp = get_spotify_client()
 
     if "track" in track_url:
         track_id = track_url.split("/")[-1].split("?")[0]
     else:
         raise ValueError("Invalid track URL")
 
-    track = sp.track(track_id)
+    track = call_with_backoff("spotify", sp.track, track_id)
     name = track.get('name', 'Unknown Track')
     artists = ', '.join([artist.get('name', 'Unknown Artist') for artist in track.get('artists', [])])
     album = track.get('album', {}).get('name', 'Unknown Album')
@@ -214,68 +817,770 @@ def get_spotify_single_track(track_url):
     print(Fore.GREEN + Style.BRIGHT + f"You're downloading track: {name}" + Style.RESET_ALL)
 
     return [{
+        'id': track.get('id'),
         'name': name,
         'artists': artists,
         'album': album,
         'track_number': track_number,
-        'year': year  
+        'year': year,
+        'duration_ms': track.get('duration_ms'),
+        'isrc': (track.get('external_ids') or {}).get('isrc'),
     }]
 
+#Apre i tag di un file audio (mutagen viene importato solo quando serve)
+def open_audio_tags(file_path):
+    """
+    Restituisce l'oggetto mutagen con i tag in forma semplificata (EasyID3 per gli MP3,
+    EasyMP4 per gli m4a, commenti Vorbis per opus/ogg): le chiavi title/artist/album/tracknumber
+    sono le stesse per tutti i formati.
+    """
+    import mutagen
+    audio = mutagen.File(file_path, easy=True)
+    if audio is None:
+        raise ValueError(f"unsupported audio file: {file_path}")
+    return audio
+
+def is_audio_file(file):
+    """True se il percorso è un file audio gestito (in base all'estensione)."""
+    return Path(file).suffix.lower() in AUDIO_EXTENSIONS
+
+#Chiave normalizzata (titolo, artista) usata per confrontare brani e file
+def normalize_key(title, artist):
+    """Restituisce la chiave (titolo, artista) in lowercase e senza spazi ai bordi."""
+    return ((title or "").strip().lower(), (artist or "").strip().lower())
+
+#Indice persistente per cartella: evita di rileggere i metadati di tutti i file ad ogni controllo
+def _empty_folder_index():
+    return {"files": {}, "keys": {}, "dirty": False}
+
+def _index_add_entry(index, file_name, title, artist, mtime, size):
+    """Inserisce (o sostituisce) la voce di un file nell'indice in memoria."""
+    _index_remove_entry(index, file_name)
+    index["files"][file_name] = {"title": title, "artist": artist, "mtime": mtime, "size": size}
+    if title and artist:
+        index["keys"].setdefault(normalize_key(title, artist), set()).add(file_name)
+    index["dirty"] = True
+
+def _index_remove_entry(index, file_name):
+    """Rimuove la voce di un file dall'indice in memoria, se presente."""
+    entry = index["files"].pop(file_name, None)
+    if entry is None:
+        return
+    key = normalize_key(entry["title"], entry["artist"])
+    names = index["keys"].get(key)
+    if names is not None:
+        names.discard(file_name)
+        if not names:
+            del index["keys"][key]
+    index["dirty"] = True
+
+def load_folder_index(output_folder):
+    """
+    Carica l'indice della cartella da disco e lo riallinea con i file presenti.
+    I file con mtime/dimensione invariati non vengono riletti, quelli nuovi o modificati
+    vengono analizzati, le voci dei file spariti vengono scartate.
+    """
+    index_path = os.path.join(output_folder, INDEX_FILE_NAME)
+    stored = {}
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") == INDEX_VERSION:
+            stored = data.get("files", {})
+    except (OSError, ValueError):
+        stored = {}
+
+    index = _empty_folder_index()
+    for file in Path(output_folder).iterdir():
+        if not is_audio_file(file):
+            continue
+        try:
+            stat = file.stat()
+        except OSError:
+            continue
+        entry = stored.get(file.name)
+        if entry and entry.get("mtime") == stat.st_mtime and entry.get("size") == stat.st_size:
+            _index_add_entry(index, file.name, entry.get("title"), entry.get("artist"), stat.st_mtime, stat.st_size)
+        else:
+            title, artist = get_file_metadata(str(file))
+            _index_add_entry(index, file.name, title, artist, stat.st_mtime, stat.st_size)
+    # L'indice va riscritto solo se differisce da quello salvato su disco
+    index["dirty"] = set(stored) != set(index["files"]) or any(
+        stored[name] != entry for name, entry in index["files"].items() if name in stored)
+
+    with index_lock:
+        folder_indexes[os.path.abspath(output_folder)] = index
+    save_folder_index(output_folder)
+    return index
+
+def get_folder_index(output_folder):
+    """Restituisce l'indice in memoria della cartella, caricandolo se necessario."""
+    with index_lock:
+        index = folder_indexes.get(os.path.abspath(output_folder))
+    if index is None:
+        index = load_folder_index(output_folder)
+    return index
+
+def save_folder_index(output_folder):
+    """
+    Scrive l'indice della cartella su disco (scrittura atomica), solo se è cambiato.
+    Altri processi (worker della coda) possono aver salvato nel frattempo: sotto lock l'indice su disco
+    viene unito a quello in memoria, tenendo solo le voci che corrispondono ancora al file (mtime e dimensione).
+    """
+    with index_lock:
+        index = folder_indexes.get(os.path.abspath(output_folder))
+        if index is None or not index["dirty"]:
+            return
+        files = dict(index["files"])
+        index["dirty"] = False
+    index_path = os.path.join(output_folder, INDEX_FILE_NAME)
+    temp_path = index_path + f".{os.getpid()}.tmp"
+    try:
+        with path_lock(index_path + ".lock"):
+            try:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                stored = data.get("files", {}) if data.get("version") == INDEX_VERSION else {}
+            except (OSError, ValueError):
+                stored = {}
+            merged = {}
+            for name, entry in {**stored, **files}.items():  # a parità di nome vince la voce in memoria
+                try:
+                    stat = os.stat(os.path.join(output_folder, name))
+                except OSError:
+                    continue  # file rinominato o eliminato da un processo
+                if entry.get("mtime") == stat.st_mtime and entry.get("size") == stat.st_size:
+                    merged[name] = entry
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": INDEX_VERSION, "files": merged}, f, ensure_ascii=False)
+            os.replace(temp_path, index_path)
+    except OSError as e:
+        log_error(f"Error saving folder index {index_path}: {e}", output_folder)
+        return
+    # I file prodotti dagli altri processi entrano anche nell'indice in memoria
+    with index_lock:
+        dirty = index["dirty"]
+        for name, entry in merged.items():
+            if name not in index["files"]:
+                _index_add_entry(index, name, entry.get("title"), entry.get("artist"), entry["mtime"], entry["size"])
+        index["dirty"] = dirty
+
+def index_add_file(output_folder, file_path, title, artist):
+    """Registra nell'indice un file finale appena prodotto (es. da rename_file)."""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return
+    index = get_folder_index(output_folder)
+    with index_lock:
+        _index_add_entry(index, Path(file_path).name, title, artist, stat.st_mtime, stat.st_size)
+
+def index_remove_file(output_folder, file_path):
+    """Rimuove dall'indice un file che è stato spostato o eliminato."""
+    index = get_folder_index(output_folder)
+    with index_lock:
+        _index_remove_entry(index, Path(file_path).name)
+
 #Funzione di supporto per tutto quello che è gia stato scaricato
 def track_already_downloaded(track, output_folder):
     """
     Controlla se un brano è già presente nella cartella, verificando i metadati (titolo e artista).
-    Vengono controllati solo i file finali (quelli con metadati).
+    Il controllo avviene sull'indice della cartella, quindi non rilegge i file ad ogni chiamata.
     """
-    for file in Path(output_folder).glob(f"*{codec}"):
+    index = get_folder_index(output_folder)
+    with index_lock:
+        return bool(index["keys"].get(normalize_key(track['name'], track['artists'])))
+
+#Pool di istanze yt_dlp.YoutubeDL riutilizzate tra le tracce, una famiglia per tipo di operazione
+YDL_OPTIONS = {
+    "search": {
+        'quiet': True,
+        'default_search': 'ytsearch5',
+        'skip_download': True,
+        # Risultati "piatti": titolo, durata e canale arrivano dalla pagina dei risultati, senza risolvere
+        # formati e firme di ogni video; l'unica risoluzione completa avviene nel download
+        'extract_flat': 'in_playlist',
+    },
+    "download": {},  # costruite da apply_download_settings() in base al .env
+}
+
+#Download: formato in base al bitrate richiesto, più connessioni per file e limite di banda condiviso da tutti i worker
+VBR_BITRATES = (245, 225, 190, 175, 165, 130, 115, 100, 85, 65)  # bitrate medio di LAME per -q:a 0..9, in kbps
+HTTP_CHUNK_SIZE = 10 * 1024 * 1024  # i file non frammentati (l'audio di YouTube) vengono scaricati a blocchi, uno dopo l'altro
+bandwidth_lock = threading.Lock()
+bandwidth_rate = 0  # byte al secondo per tutto il processo, 0 = nessun limite
+bandwidth_tokens = 0.0
+bandwidth_updated = time.monotonic()
+bandwidth_seen = {}  # file in download -> byte già conteggiati
+
+def parse_byte_rate(value):
+    """Converte un valore come "800K", "8M" o "1.5MB" in byte al secondo; vuoto o 0 = nessun limite."""
+    number = (value or "").strip().upper()
+    number = (number[:-2] if number.endswith("/S") else number).rstrip("B")
+    if not number:
+        return 0
+    multiplier = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(number[-1], 1)
+    try:
+        return max(0, int(float(number.rstrip("KMG")) * multiplier))
+    except ValueError:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid BANDWIDTH_LIMIT '{value}', no limit applied.")
+        return 0
+
+def target_bitrate():
+    """Bitrate in kbps che il file finale deve avere secondo PREFERRED_QUALITY (qualità VBR o bitrate)."""
+    quality = os.getenv("PREFERRED_QUALITY", "192").strip().rstrip("kK") or "192"
+    try:
+        value = float(quality)
+    except ValueError:
+        return 192
+    return VBR_BITRATES[int(value)] if value < 10 else int(value)
+
+def download_format():
+    """
+    Selettore di formato per yt-dlp. Per l'MP3 basta il flusso più piccolo che raggiunge già il bitrate
+    di destinazione: uno più grande verrebbe comunque ricompresso da FFmpeg. Se nessun formato lo raggiunge
+    (o il bitrate non è noto) si torna al migliore. In passthrough il flusso resta quello finale, quindi il migliore.
+    I flussi audio di YouTube arrivano al massimo a circa 160 kbps: con PREFERRED_QUALITY=192 (il default)
+    il primo ramo non trova mai nulla e viene sempre scelto il migliore; serve solo con valori più bassi.
+    """
+    if audio_format == "passthrough":
+        return 'bestaudio/best'
+    return f'worstaudio[abr>={target_bitrate()}]/bestaudio/best'
+
+def throttle_bandwidth(nbytes):
+    """Consuma nbytes dal secchio di banda condiviso; se è in debito attende il tempo necessario a ripagarlo."""
+    global bandwidth_tokens, bandwidth_updated
+    with bandwidth_lock:
+        rate = bandwidth_rate
+        if not rate:
+            return
+        now = time.monotonic()
+        # Al massimo un secondo di credito accumulato, così una pausa non consente un picco oltre il limite
+        bandwidth_tokens = min(rate, bandwidth_tokens + (now - bandwidth_updated) * rate) - nbytes
+        bandwidth_updated = now
+        wait = -bandwidth_tokens / rate if bandwidth_tokens < 0 else 0
+    if wait:
+        time.sleep(wait)  # fuori dal lock: gli altri worker si mettono in coda sul debito già accumulato
+
+def _bandwidth_hook(status):
+    """Progress hook di yt-dlp: passa al secchio condiviso i byte ricevuti dall'ultima chiamata."""
+    filename = status.get('tmpfilename') or status.get('filename')
+    if status.get('status') != 'downloading':
+        with bandwidth_lock:
+            bandwidth_seen.pop(filename, None)
+        return
+    downloaded = status.get('downloaded_bytes') or 0
+    with bandwidth_lock:
+        delta = downloaded - bandwidth_seen.get(filename, 0)
+        bandwidth_seen[filename] = downloaded
+    if delta > 0:
+        throttle_bandwidth(delta)
+
+def apply_download_settings():
+    """
+    Ricostruisce le opzioni di download dal .env. Le istanze già create hanno il selettore di formato
+    costruito alla creazione, quindi cambia la generazione: quelle nel pool vengono scartate subito,
+    quelle prestate quando vengono restituite.
+    """
+    global bandwidth_rate, bandwidth_tokens
+    connections = env_int("DOWNLOAD_CONNECTIONS", 4)
+    limit = parse_byte_rate(os.getenv("BANDWIDTH_LIMIT", ""))
+    options = {
+        'format': download_format(),
+        'quiet': True,
+        'concurrent_fragment_downloads': connections,  # solo flussi DASH/HLS: l'audio di YouTube è un file unico
+    }
+    external = os.getenv("EXTERNAL_DOWNLOADER", "").strip().lower()
+    if external == "aria2c" and shutil.which("aria2c"):
+        # aria2c apre più connessioni sullo stesso file; il limite globale diventa una quota per download
+        options['external_downloader'] = {'default': 'aria2c'}
+        options['external_downloader_args'] = {'aria2c': ['-x', str(connections), '-s', str(connections), '-k', '1M']}
+        if limit:
+            options['ratelimit'] = max(1, limit // max(1, download_threads))
+        limit = 0  # aria2c non chiama i progress hook durante il download
+    else:
+        if external:
+            print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"EXTERNAL_DOWNLOADER '{external}' not available, using the built-in downloader.")
+        options['http_chunk_size'] = HTTP_CHUNK_SIZE
+        options['progress_hooks'] = [_bandwidth_hook]
+    with bandwidth_lock:
+        bandwidth_rate = limit
+        bandwidth_tokens = float(limit)
+    YDL_OPTIONS["download"] = options
+    ydl_generations["download"] += 1
+    while True:
         try:
-            audio = MP3(str(file), ID3=EasyID3)
-            title = audio.get('title', [None])[0]
-            artist = audio.get('artist', [None])[0]
-            if title and artist:
-                if title.strip().lower() == track['name'].strip().lower() and artist.strip().lower() == track['artists'].strip().lower():
-                    return True
-        except Exception:
+            ydl_pools["download"].get_nowait()
+        except queue.Empty:
+            break
+
+apply_download_settings()
+
+@contextmanager
+def borrow_ydl(kind):
+    """
+    Presta un'istanza YoutubeDL già inizializzata del tipo richiesto ("search" o "download").
+    Se il pool è vuoto ne crea una nuova; alla fine l'istanza torna nel pool, così la
+    registrazione degli estrattori e il parsing delle opzioni avvengono una sola volta.
+    Un'istanza creata con opzioni ormai cambiate (generazione vecchia) non torna nel pool.
+    """
+    generation, ydl = ydl_generations[kind], None
+    while ydl is None:
+        try:
+            pooled_generation, ydl = ydl_pools[kind].get_nowait()
+        except queue.Empty:
+            import yt_dlp
+            ydl = yt_dlp.YoutubeDL(dict(YDL_OPTIONS[kind]))
+            break
+        if pooled_generation != generation:
+            ydl = None  # rientrata nel pool mentre le opzioni cambiavano
+    try:
+        yield ydl
+    finally:
+        if generation == ydl_generations[kind]:
+            ydl_pools[kind].put((generation, ydl))
+
+def set_outtmpl(ydl, outtmpl):
+    """Cambia il modello del nome di output di un'istanza già creata, senza ricostruirla."""
+    templates = ydl.params.get('outtmpl')
+    if not isinstance(templates, dict):
+        templates = ydl.params['outtmpl'] = {}
+    templates['default'] = outtmpl  # le altre voci (thumbnail, ecc.) restano quelle di default
+    if hasattr(ydl, 'outtmpl_dict'):  # versioni di yt-dlp meno recenti
+        ydl.outtmpl_dict['default'] = outtmpl
+
+#Punteggio dei risultati di YouTube rispetto ai dati di Spotify: si scarica solo il candidato migliore
+def _match_text(text):
+    """Testo in minuscolo e senza punteggiatura, per confrontare titoli, canali e artisti."""
+    return " ".join(re.sub(r"[^\w]+", " ", (text or "").casefold()).split())
+
+def score_candidate(entry, track):
+    """
+    Valuta un risultato della ricerca rispetto al brano di Spotify: differenza di durata, canale
+    ufficiale ("Artista - Topic", verificato o VEVO), somiglianza di titolo e artista, parole come
+    "live" o "loop" che il brano non ha. Ritorna il punteggio, oppure None se la durata è così
+    diversa che il video non può essere il brano (versioni live lunghe, loop di un'ora, video con intro).
+    """
+    if not track:
+        return 0.0
+    score = 0.0
+    expected = (track.get('duration_ms') or 0) / 1000
+    duration = entry.get('duration')
+    if expected and duration:
+        delta = abs(duration - expected)
+        tolerance = max(MATCH_MAX_DURATION_DELTA, expected * 0.1)
+        if delta > tolerance:
+            return None
+        score += 40 * (1 - delta / tolerance)
+
+    channel = entry.get('channel') or entry.get('uploader') or ""
+    if channel.endswith(" - Topic"):
+        score += 25  # canali generati da YouTube con l'audio ufficiale
+    elif entry.get('channel_is_verified') or "vevo" in channel.lower():
+        score += 10
+
+    title = _match_text(entry.get('title'))
+    name = _match_text(track.get('name'))
+    main_artist = _match_text((track.get('artists') or "").split(",")[0])
+    if main_artist and any(main_artist in text for text in (_match_text(channel), title, _match_text(entry.get('artist')))):
+        score += 10
+    score += 20 if name and name in title else 20 * difflib.SequenceMatcher(None, name, title).ratio()
+    for word in MATCH_UNWANTED_WORDS:
+        pattern = rf"\b{word}\b"
+        if re.search(pattern, title) and not re.search(pattern, name):
+            score -= 30
+    return score
+
+def pick_best_candidate(entries, track):
+    """Restituisce l'URL del risultato con il punteggio più alto (a parità, il primo), o None se nessuno è adatto."""
+    best_url, best_score = None, None
+    for entry in entries or []:
+        webpage_url = (entry or {}).get('webpage_url') or (entry or {}).get('url')  # i risultati piatti hanno solo 'url'
+        if not webpage_url:
+            continue
+        score = score_candidate(entry, track)
+        if score is None:
+            count_metric("search_candidates_rejected")
             continue
-    return False
+        if best_score is None or score > best_score:
+            best_url, best_score = webpage_url, score
+    return best_url
 
 #Funzione nella quale avviene la composizione della query per ricercare le canzoni
-def search_youtube(query, output_folder):
+def search_youtube(query, output_folder, status=None, track=None):
     """
     Cerca un video su YouTube utilizzando yt-dlp.
-    Prova prima con la query originale e, in caso di errore (ad esempio 403), prova ad aggiungere "lyrics".
-    Restituisce l'URL del primo risultato disponibile.
+    Prova prima con la query originale e, se nessun risultato è adatto o la ricerca fallisce
+    (ad esempio 403), prova ad aggiungere "lyrics".
+    Se viene passato il brano di Spotify (track) i risultati vengono valutati con score_candidate
+    e viene restituito l'URL del migliore; altrimenti quello del primo risultato disponibile.
+    Se viene passato il dict status, status['error'] diventa True quando una ricerca fallisce con un errore.
     """
-    ydl_opts = {
-        'quiet': True,
-        'default_search': 'ytsearch5',
-        'skip_download': True,
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with borrow_ydl("search") as ydl:
         try:
-            info = ydl.extract_info(query, download=False)
+            info = call_with_backoff("youtube", ydl.extract_info, query, download=False)
         except Exception as e:
             log_error(f"YouTube search error for query '{query}': {e}", output_folder)
+            if status is not None:
+                status['error'] = True
             info = None
-        if info and 'entries' in info and len(info['entries']) > 0:
-            for entry in info['entries']:
-                webpage_url = entry.get('webpage_url')
-                if webpage_url:
-                    return webpage_url
-    # Se la ricerca con la query originale non ha prodotto risultati, prova con "lyrics"
+        webpage_url = pick_best_candidate((info or {}).get('entries'), track)
+        if webpage_url:
+            return webpage_url
+    # Se la ricerca con la query originale non ha prodotto risultati adatti, prova con "lyrics"
     alt_query = query + " lyrics"
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with borrow_ydl("search") as ydl:
         try:
-            info = ydl.extract_info(alt_query, download=False)
+            info = call_with_backoff("youtube", ydl.extract_info, alt_query, download=False)
         except Exception as e:
             log_error(f"YouTube search error for alternative query '{alt_query}': {e}", output_folder)
+            if status is not None:
+                status['error'] = True
             return None
-        if info and 'entries' in info and len(info['entries']) > 0:
-            for entry in info['entries']:
-                webpage_url = entry.get('webpage_url')
-                if webpage_url:
-                    return webpage_url
-    return None
+        return pick_best_candidate((info or {}).get('entries'), track)
+
+
+#Cache persistente delle ricerche su YouTube, condivisa tra esecuzioni e playlist
+def search_cache_key(track, query):
+    """
+    La chiave è l'ID Spotify del brano se disponibile, altrimenti la query normalizzata, preceduti dalla
+    versione del punteggio: i risultati scelti con regole vecchie non vengono riusati e scadono da soli.
+    """
+    if track.get('id'):
+        return f"v{MATCH_SCORING_VERSION}:id:{track['id']}"
+    return f"v{MATCH_SCORING_VERSION}:q:" + " ".join(query.lower().split())
+
+def load_search_cache():
+    """Carica la cache da disco una sola volta per processo, scartando le voci scadute."""
+    global search_cache
+    with search_cache_lock:
+        if search_cache is not None:
+            return search_cache
+        search_cache = OrderedDict()
+        try:
+            with open(SEARCH_CACHE_FILE, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            # Le voci sono salvate dalla meno alla più recentemente usata
+            for key, entry in data.get("entries", []):
+                if entry.get("expires", 0) > now:
+                    search_cache[key] = entry
+        except (OSError, ValueError, TypeError):
+            pass
+        return search_cache
+
+def save_search_cache():
+    """
+    Salva la cache su disco (scrittura atomica) se è stata modificata. Sotto lock unisce prima le voci
+    salvate da altri processi, così i worker della coda non si cancellano a vicenda le ricerche.
+    """
+    global search_cache_dirty
+    with search_cache_lock:
+        if search_cache is None or not search_cache_dirty:
+            return
+        entries = list(search_cache.items())
+        search_cache_dirty = False
+    temp_path = SEARCH_CACHE_FILE + f".{os.getpid()}.tmp"
+    try:
+        with path_lock(SEARCH_CACHE_FILE + ".lock"):
+            merged = OrderedDict()
+            try:
+                with open(SEARCH_CACHE_FILE, "r", encoding="utf-8") as f:
+                    now = time.time()
+                    for key, entry in json.load(f).get("entries", []):
+                        if entry.get("expires", 0) > now:
+                            merged[key] = entry
+            except (OSError, ValueError, TypeError):
+                pass
+            for key, entry in entries:  # le voci di questo processo diventano le più recenti
+                merged[key] = entry
+                merged.move_to_end(key)
+            while len(merged) > SEARCH_CACHE_MAX_ENTRIES:
+                merged.popitem(last=False)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": list(merged.items())}, f, ensure_ascii=False)
+            os.replace(temp_path, SEARCH_CACHE_FILE)
+    except OSError as e:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error saving search cache: {e}")
+
+def search_cache_get(key):
+    """
+    Ritorna (True, url) se la chiave è in cache e non è scaduta, altrimenti (False, None).
+    url vale None per i risultati negativi (brano non trovato).
+    """
+    cache = load_search_cache()
+    with search_cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return False, None
+        if entry["expires"] <= time.time():
+            del cache[key]
+            return False, None
+        cache.move_to_end(key)  # LRU: la voce appena usata diventa la più recente
+        return True, entry["url"]
+
+def search_cache_put(key, url):
+    """Memorizza il risultato di una ricerca; i risultati negativi scadono prima."""
+    global search_cache_dirty
+    cache = load_search_cache()
+    ttl = SEARCH_CACHE_TTL if url else SEARCH_CACHE_NEGATIVE_TTL
+    with search_cache_lock:
+        cache[key] = {"url": url, "expires": time.time() + ttl}
+        cache.move_to_end(key)
+        while len(cache) > SEARCH_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)  # elimina la voce usata meno di recente
+        search_cache_dirty = True
+
+def cached_search_youtube(track, query, output_folder):
+    """Come search_youtube, ma consulta prima la cache persistente e vi salva il risultato."""
+    key = search_cache_key(track, query)
+    hit, url = search_cache_get(key)
+    if hit:
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Search cache hit: {query}")
+        count_metric("search_cache_hits")
+        return url
+    status = {'error': False}
+    with search_slots:
+        started = time.monotonic()
+        url = search_youtube(query, output_folder, status, track)
+        observe_stage("search", time.monotonic() - started, ok=not status['error'])
+    # Un errore (es. 403) non è un risultato negativo: non va messo in cache
+    if url or not status['error']:
+        search_cache_put(key, url)
+    return url
+
+
+#Giornale per cartella: registra a che punto è ogni traccia, così un'esecuzione interrotta riprende da lì
+def journal_key(track):
+    if track.get('id'):
+        return f"id:{track['id']}"
+    return "key:" + "|".join(normalize_key(track['name'], track['artists']))
+
+def hold_folder_activity(output_folder):
+    """
+    Segnala che un'esecuzione sta lavorando nella cartella (lock condiviso, anche tra processi).
+    Ritorna True se in quel momento nessun'altra esecuzione era attiva, cioè se è sicuro
+    eliminare i file temporanei che il giornale non conosce.
+    """
+    if fcntl is None:
+        return False
+    lock_file = open(os.path.join(output_folder, ACTIVITY_LOCK_NAME), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        exclusive = True
+    except OSError:
+        exclusive = False
+    fcntl.flock(lock_file, fcntl.LOCK_SH)  # da qui in poi le altre esecuzioni possono partire
+    with journal_lock:
+        activity_locks.setdefault(os.path.abspath(output_folder), []).append(lock_file)
+    return exclusive
+
+def release_folder_activity(output_folder):
+    """Rilascia il lock preso da hold_folder_activity."""
+    with journal_lock:
+        held = activity_locks.get(os.path.abspath(output_folder))
+        lock_file = held.pop() if held else None
+    if lock_file is not None:
+        lock_file.close()  # la chiusura rilascia anche il flock
+
+def open_journal(output_folder):
+    """
+    Carica il giornale della cartella (ultimo stato di ogni traccia) ed elimina i file temporanei
+    rimasti orfani da esecuzioni precedenti, cioè quelli che nessuna traccia in corso può riprendere.
+    La pulizia avviene solo se nessun'altra esecuzione (processo della coda, lavoro del demone) usa
+    la cartella: i suoi download in corso non sono nel giornale di questo processo.
+    """
+    exclusive = hold_folder_activity(output_folder)
+    journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    entries = {}
+    try:
+        with open(journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # riga troncata da un crash durante la scrittura
+                entries.setdefault(record["key"], {}).update(record)
+    except OSError:
+        pass
+    entries = {key: entry for key, entry in entries.items() if entry.get("stage") not in JOURNAL_CLOSED_STAGES}
+
+    # Un file temporaneo è da tenere solo se appartiene a una traccia non ancora completata
+    keep = set()
+    for entry in entries.values():
+        if entry.get("temp_name"):
+            keep.add(entry["temp_name"])
+        if entry.get("temp_file"):
+            keep.add(Path(entry["temp_file"]).name.split(".")[0])
+    stale_before = time.time() - STALE_TEMP_SECONDS
+    for file in Path(output_folder).iterdir():
+        match = TEMP_FILE_PATTERN.match(file.name)
+        if match and match.group(1) not in keep and file.is_file():
+            try:
+                if not exclusive and (fcntl is not None or file.stat().st_mtime > stale_before):
+                    continue
+                file.unlink()
+                print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Removed stale temporary file: {file.name}")
+            except OSError:
+                pass
+
+    with journal_lock:
+        journals[os.path.abspath(output_folder)] = entries
+    compact_journal(output_folder)
+
+def journal_get(output_folder, track):
+    """Restituisce l'ultimo stato registrato per la traccia, o None."""
+    with journal_lock:
+        entries = journals.get(os.path.abspath(output_folder))
+        if entries is None:
+            return None
+        entry = entries.get(journal_key(track))
+        return dict(entry) if entry else None
+
+def journal_record(output_folder, track, stage, **fields):
+    """Registra (in append, una riga JSON) il nuovo stato di una traccia."""
+    key = journal_key(track)
+    record = {"key": key, "stage": stage, **fields}
+    with journal_lock:
+        entries = journals.get(os.path.abspath(output_folder))
+        if entries is None:
+            return  # giornale non aperto (es. addmeta): niente da registrare
+        entries.setdefault(key, {}).update(record)
+        with open(os.path.join(output_folder, JOURNAL_FILE_NAME), "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+def compact_journal(output_folder):
+    """Riscrive il giornale tenendo solo le tracce non completate; se non ne restano lo elimina."""
+    journal_path = os.path.join(output_folder, JOURNAL_FILE_NAME)
+    with journal_lock:
+        entries = journals.get(os.path.abspath(output_folder), {})
+        pending = {key: entry for key, entry in entries.items() if entry.get("stage") not in JOURNAL_CLOSED_STAGES}
+        journals[os.path.abspath(output_folder)] = pending
+        try:
+            if not pending:
+                if os.path.exists(journal_path):
+                    os.remove(journal_path)
+                return
+            temp_path = journal_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                for entry in pending.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temp_path, journal_path)
+        except OSError as e:
+            log_error(f"Error compacting journal {journal_path}: {e}", output_folder)
+
+def close_journal(output_folder):
+    """Compatta il giornale a fine esecuzione e lo scarica dalla memoria."""
+    compact_journal(output_folder)
+    with journal_lock:
+        journals.pop(os.path.abspath(output_folder), None)
+    release_folder_activity(output_folder)
+
+#Archivio dei fallimenti: per ogni brano fallito ricorda fase, tipo di errore e tentativi, per riprovare solo quelli
+def get_failures(output_folder):
+    """
+    Legge da disco l'archivio dei fallimenti della cartella. Non viene tenuto in memoria: worker della coda,
+    demone e retry-failed lo modificano da processi diversi, quindi ogni lettura deve vedere l'ultima versione.
+    """
+    try:
+        with open(os.path.join(output_folder, FAILURES_FILE_NAME), "r", encoding="utf-8") as f:
+            failures = json.load(f)
+        return failures if isinstance(failures, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def _update_failures(output_folder, change):
+    """
+    Rilegge l'archivio, applica change(failures) e lo riscrive (o lo elimina se è vuoto), tutto sotto lock
+    anche tra processi: le modifiche degli altri non vengono sovrascritte. change ritorna False se non ha cambiato nulla.
+    """
+    path = os.path.join(output_folder, FAILURES_FILE_NAME)
+    with failures_lock, path_lock(path + ".lock"):
+        failures = get_failures(output_folder)
+        if change(failures) is False:
+            return
+        try:
+            if failures:
+                temp_path = path + f".{os.getpid()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(failures, f, ensure_ascii=False, indent=1)
+                os.replace(temp_path, path)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Cannot write {path}: {e}")
+
+def track_failed(output_folder, track, stage, message, error=None):
+    """
+    Registra il fallimento di un brano: scrive il messaggio in log.txt, aggiorna le metriche e
+    l'archivio dei fallimenti con fase, classe dell'errore, numero di tentativi e prossimo tentativo utile.
+    """
+    log_error(message, output_folder)
+    record_failure(stage)
+    # Chiude la voce del giornale: il nuovo tentativo ripartirà da capo, guidato dall'archivio dei fallimenti
+    journal_record(output_folder, track, "failed")
+    now = time.time()
+
+    def change(failures):
+        attempts = failures.get(journal_key(track), {}).get("attempts", 0) + 1
+        delay = min(RETRY_BACKOFF_CAP, RETRY_BACKOFF.get(stage, 60.0) * 2 ** (attempts - 1))
+        failures[journal_key(track)] = {
+            "track": dict(track),
+            "stage": stage,
+            "error": type(error).__name__ if error is not None else None,
+            "message": message,
+            "attempts": attempts,
+            "last_attempt": now,
+            "next_retry": now + delay,
+        }
+
+    _update_failures(output_folder, change)
+
+def track_succeeded(output_folder, track):
+    """Toglie il brano dall'archivio dei fallimenti, se c'era."""
+    if not os.path.exists(os.path.join(output_folder, FAILURES_FILE_NAME)):
+        return  # caso comune: nessun fallimento nella cartella, nessuna lettura
+    _update_failures(output_folder, lambda failures: failures.pop(journal_key(track), None) is not None)
+
+#si occupa del comando retry-failed
+def retry_failed(folders=None, force=False):
+    """
+    Riprova solo i brani dell'archivio dei fallimenti (di default nelle cartelle delle playlist salvate)
+    il cui tempo di attesa è scaduto; con force=True li riprova tutti subito.
+    Ritorna il numero di brani riprovati che sono falliti di nuovo.
+    """
+    if folders is None:
+        _, folders = load_entries()
+    now = time.time()
+    retried = 0
+    waiting = 0
+    for folder in dict.fromkeys(folders):  # stessa cartella una sola volta, nell'ordine originale
+        if not os.path.isdir(folder):
+            continue
+        failures = get_failures(folder)
+        due = [entry["track"] for entry in failures.values() if force or entry.get("next_retry", 0) <= now]
+        waiting += len(failures) - len(due)
+        if not due:
+            continue
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Retrying {len(due)} failed tracks in {folder}")
+        load_folder_index(folder)
+        open_journal(folder)  # i brani riprendono dall'URL già trovato o dal download interrotto
+        if pipeline_mode:
+            run_pipeline(due, folder)
+        else:
+            run_batch_phases(due, folder)
+        phase4_verification(folder)
+        save_folder_index(folder)
+        close_journal(folder)
+        retried += len(due)
+    save_search_cache()
+    write_metrics()
+    flush_writes()
+
+    still_failing = sum(len(get_failures(folder)) for folder in dict.fromkeys(folders) if os.path.isdir(folder))
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{retried} tracks retried, {still_failing - waiting} still failing, {waiting} waiting for their next retry.")
+    return still_failing - waiting
 
 
 # === FASE 1: Download dei file (senza metadati e senza rinomina) ===
@@ -283,61 +1588,178 @@ def download_track(track, output_folder):
     """
     Scarica il brano da YouTube e restituisce il percorso del file temporaneo.
     Se il brano è già presente (verificato sui file finali) o in elaborazione, ritorna None.
+    Esegue in sequenza le tre fasi (ricerca, download, conversione) nel thread chiamante: la usano
+    la coda condivisa e la modalità a fasi; la pipeline invece dà a ogni fase il suo gruppo di thread.
+    """
+    step = prepare_download(track, output_folder)
+    if step is None or "temp_file" in step:
+        return step and step["temp_file"]
+    step = fetch_source(step)
+    return transcode_source(step) if step else None
+
+def prepare_download(track, output_folder):
+    """
+    Fase di ricerca: salta i brani già presenti o in lavorazione, riprende dal giornale, usa l'archivio
+    o la libreria e, se serve, cerca il video su YouTube.
+    Ritorna None (brano saltato o non trovato), {"temp_file"} se il file temporaneo è già pronto,
+    altrimenti il passo da passare a fetch_source: {"track", "folder", "url", "temp_name"}.
     """
     #Il codice verifica se una traccia è già in fase di elaborazione o se è stata scaricata. Se sì, la salta. Altrimenti, crea una query di ricerca su YouTube per la traccia e l'artista. Se non trova il video su YouTube, registra l'errore e continua.
-    key = (track['name'].strip().lower(), track['artists'].strip().lower())
-    if key in in_processing or track_already_downloaded(track, output_folder):
+    key = processing_key(track, output_folder)
+    with in_processing_lock:  # controllo e prenotazione atomici tra i thread
+        busy = key in in_processing
+        if not busy:
+            in_processing.add(key)
+    if busy:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Skipping, already exists or in processing: {track['name']} - {track['artists']}")
+        count_metric("tracks_skipped")
+        return None
+    if track_already_downloaded(track, output_folder):
         print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Skipping, already exists or in processing: {track['name']} - {track['artists']}")
+        count_metric("tracks_skipped")
+        track_succeeded(output_folder, track)  # il brano c'è: un vecchio fallimento non va più riprovato
+        if journal_get(output_folder, track):
+            journal_record(output_folder, track, "renamed")  # completata prima di un crash: chiude la voce
+        finalize_track_processing(track, output_folder)
         return None
 
-    in_processing.add(key)
+    # Ripresa dopo un'interruzione: il giornale dice fin dove era arrivata la traccia
+    entry = journal_get(output_folder, track) or {}
+    if entry.get("stage") in ("downloaded", "tagged") and os.path.exists(os.path.join(output_folder, entry.get("temp_file", ""))):
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Resuming from stage '{entry['stage']}': {track['name']}")
+        return {"temp_file": os.path.join(output_folder, entry["temp_file"])}
+
+    # Se l'archivio centrale o un'altra cartella della libreria hanno già il brano, niente ricerca né download
+    stored_file = store_lookup(track)
+    source = "track store"
+    if not stored_file:
+        stored_file = library_find_file(track, output_folder)
+        source = "library"
+    if stored_file:
+        temp_file = str(Path(output_folder) / uuid.uuid4().hex) + Path(stored_file).suffix
+        # Copia privata: i tag vengono riscritti, e un hardlink modificherebbe anche l'archivio e le altre cartelle.
+        # Dopo la rinomina store_track_file sostituisce la copia con un collegamento all'archivio.
+        shutil.copy2(stored_file, temp_file)
+        journal_record(output_folder, track, "downloaded", temp_file=Path(temp_file).name)
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Found in the {source}: {track['name']}")
+        count_metric("track_store_hits" if source == "track store" else "library_hits")
+        return {"temp_file": temp_file}
+
     query = f"{track['name']} \"{track['artists']}\""
-    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Searching: {query}")
-    youtube_url = search_youtube(query, output_folder)
+    youtube_url = entry.get("url") or library_youtube_url(track)  # video già scelto in una sincronizzazione precedente
+    if not youtube_url:
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Searching: {query}")
+        youtube_url = cached_search_youtube(track, query, output_folder)
     if not youtube_url:
-        log_error(f"Not found on YouTube: {query}", output_folder)
-        in_processing.remove(key)
+        track_failed(output_folder, track, "not_found", f"Not found on YouTube: {query}")
+        finalize_track_processing(track, output_folder)
         return None
+    journal_record(output_folder, track, "searched", url=youtube_url)
+    library_record_track(track, youtube_url)
+    return {"track": track, "folder": output_folder, "url": youtube_url, "temp_name": entry.get("temp_name")}
 
+def fetch_source(step):
+    """
+    Fase di download (rete): scarica il flusso audio del video scelto così com'è.
+    Ritorna il passo con "source_file" e "temp_base" per transcode_source, None in caso di errore.
+    """
+    track, output_folder, youtube_url = step["track"], step["folder"], step["url"]
     print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Downloading from: {youtube_url}")
-    temp_name = uuid.uuid4().hex
+    # Riusa il nome temporaneo di un download interrotto: yt-dlp riprende il file .part da dove era rimasto
+    temp_name = step.get("temp_name") or uuid.uuid4().hex
+    journal_record(output_folder, track, "downloading", temp_name=temp_name)
     temp_output_path = Path(output_folder) / temp_name
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': "mp3", #hardcoded mp3 file format, si come ho problemi con il supporto di altri tipi di file
-            'preferredquality': os.getenv("PREFERRED_QUALITY", "192"),
-        }],
-        'outtmpl': str(temp_output_path),
-        'quiet': True,
-    }
-
+    # Il flusso audio viene scaricato così com'è: la conversione avviene dopo, nel pool dedicato a FFmpeg
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([youtube_url]) #qui avviene l'effettivo download delle tracce
+        with download_slots:
+            started = time.monotonic()  # il tempo di attesa per uno slot non conta come download
+            with borrow_ydl("download") as ydl:
+                set_outtmpl(ydl, str(temp_output_path) + '.src.%(ext)s')
+                # Una sola risoluzione del video: il dict restituito dice anche dove è stato salvato il file
+                info = call_with_backoff("youtube", ydl.extract_info, youtube_url, download=True) #qui avviene l'effettivo download delle tracce
     except Exception as e:
-        log_error(f"Download error for {track['name']}: {e}", output_folder)
-        in_processing.remove(key)
+        observe_stage("download", time.monotonic() - started, ok=False)
+        library_forget_youtube(track)  # video rimosso o non scaricabile: al prossimo tentativo si cerca di nuovo
+        track_failed(output_folder, track, "download", f"Download error for {track['name']}: {e}", e)
+        finalize_track_processing(track, output_folder)
         return None
 
-    temp_file = str(temp_output_path) + codec
-    if not os.path.exists(temp_file):
-        log_error(f"Temporary file not found for {track['name']}", output_folder)
-        in_processing.remove(key)
+    downloaded = [Path(item['filepath']) for item in (info or {}).get('requested_downloads') or [] if item.get('filepath')]
+    source_files = [f for f in downloaded if f.exists()] or \
+        [f for f in Path(output_folder).glob(f"{temp_name}.src.*") if f.suffix != ".part"]  # versioni di yt-dlp senza requested_downloads
+    if not source_files:
+        observe_stage("download", time.monotonic() - started, ok=False)
+        track_failed(output_folder, track, "download", f"Temporary file not found for {track['name']}")
+        finalize_track_processing(track, output_folder)
+        return None
+    observe_stage("download", time.monotonic() - started, nbytes=source_files[0].stat().st_size)
+    return {**step, "source_file": str(source_files[0]), "temp_base": str(temp_output_path)}
+
+def transcode_source(step):
+    """Fase di conversione (CPU, un processo FFmpeg per brano). Ritorna il file temporaneo finale o None."""
+    track, output_folder = step["track"], step["folder"]
+    with transcode_slots:
+        started = time.monotonic()
+        temp_file = transcode_audio(step["source_file"], step["temp_base"], output_folder)
+        observe_stage("transcode", time.monotonic() - started, ok=bool(temp_file))
+    if not temp_file:
+        track_failed(output_folder, track, "transcode", f"Transcoding error for {track['name']}")
+        finalize_track_processing(track, output_folder)
         return None
 
+    journal_record(output_folder, track, "downloaded", temp_file=Path(temp_file).name)
+    return temp_file
+
+
+# === FASE 1b: Conversione audio con FFmpeg ===
+def transcode_audio(source_file, temp_base, output_folder):
+    """
+    Converte il flusso scaricato nel formato finale con FFmpeg e rimuove il file sorgente.
+    Con AUDIO_FORMAT=mp3 la qualità segue PREFERRED_QUALITY come faceva FFmpegExtractAudio:
+    un valore sotto 10 è una qualità VBR, altrimenti è un bitrate in kbps.
+    Con AUDIO_FORMAT=passthrough il flusso audio viene solo copiato in un contenitore adatto ai tag
+    (webm -> opus, mp4 -> m4a): nessuna ricodifica, quindi niente CPU spesa e nessuna perdita di qualità.
+    Ritorna il percorso del file prodotto (temp_base + estensione), None in caso di errore.
+    """
+    passthrough_ext = PASSTHROUGH_EXTENSIONS.get(Path(source_file).suffix.lower())
+    if audio_format == "passthrough" and passthrough_ext:
+        temp_file = temp_base + passthrough_ext
+        codec_args = ['-codec:a', 'copy']
+    else:
+        temp_file = temp_base + codec
+        quality = os.getenv("PREFERRED_QUALITY", "192").strip() or "192"
+        quality_args = ['-q:a', quality] if quality.isdigit() and int(quality) < 10 else ['-b:a', f"{quality.rstrip('kK')}k"]
+        codec_args = ['-codec:a', 'libmp3lame', *quality_args]
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-i', source_file, '-vn',
+               *codec_args, temp_file]
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    except OSError as e:
+        log_error(f"FFmpeg could not be started for {source_file}: {e}", output_folder)
+        return None
+    finally:
+        try:
+            os.remove(source_file)
+        except OSError:
+            pass
+    if result.returncode != 0 or not os.path.exists(temp_file):
+        log_error(f"FFmpeg error for {source_file}: {result.stderr.strip()}", output_folder)
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return None
     return temp_file
 
 
 # === FASE 2: Aggiunta metadati ===
 def add_metadata_to_file(temp_file, track_info, output_folder):
     """
-    Aggiunge i metadati al file audio in base al codec scelto.
+    Aggiunge i metadati al file audio (MP3, m4a o opus: le chiavi sono comuni, vedi open_audio_tags).
     Ritorna True se va a buon fine, False altrimenti.
     """
+    started = time.monotonic()
     try:
-        audio = MP3(temp_file, ID3=EasyID3)
+        detach_hardlink(temp_file)
+        audio = open_audio_tags(temp_file)
         audio['title'] = track_info['name']
         audio['artist'] = track_info['artists']
         audio['album'] = track_info['album']
@@ -346,13 +1768,144 @@ def add_metadata_to_file(temp_file, track_info, output_folder):
             audio['tracknumber'] = str(track_info['track_number'])
         audio.save()
         del audio  # Rilascia la risorsa
+        observe_stage("tag", time.monotonic() - started)
         return True
     except Exception as e:
+        observe_stage("tag", time.monotonic() - started, ok=False)
         log_error(f"Error adding metadata for {track_info['name']}: {e}", output_folder)
         return False
 
 
 
+#Archivio centrale dei brani: un solo file per brano, collegato (hardlink) nelle cartelle delle playlist
+def link_or_copy(source, destination):
+    """Crea un hardlink; se non è possibile (es. dischi diversi) ripiega su una copia. Ritorna True se è un link."""
+    try:
+        os.link(source, destination)
+        return True
+    except OSError:
+        shutil.copy2(source, destination)
+        return False
+
+def detach_hardlink(file_path):
+    """
+    Se il file ha altri hardlink (archivio centrale o altre cartelle) lo sostituisce con una copia privata,
+    così la modifica dei tag non cambia anche le altre copie e i file by-hash restano coerenti con il loro hash.
+    """
+    if os.stat(file_path).st_nlink > 1:
+        temp_copy = file_path + ".detach"
+        shutil.copy2(file_path, temp_copy)
+        os.replace(temp_copy, file_path)
+
+def file_content_hash(file_path):
+    """Calcola lo SHA-256 del file leggendolo a blocchi, senza caricarlo tutto in memoria."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(STORE_HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def store_path_for(key_type, key, extension=codec):
+    """Percorso nell'archivio: le sottocartelle a due caratteri evitano directory enormi."""
+    return os.path.join(track_store, key_type, key[:2], key + extension)
+
+def store_lookup(track):
+    """Ritorna il file dell'archivio per l'ID Spotify del brano, in qualunque formato audio, se esiste."""
+    if not track_store or not track.get('id'):
+        return None
+    for extension in AUDIO_EXTENSIONS:
+        stored_file = store_path_for("by-id", track['id'], extension)
+        if os.path.exists(stored_file):
+            return stored_file
+    return None
+
+def fold_into_store(file_path, stored_file, allow_copy=True):
+    """
+    Sostituisce file_path con un hardlink a stored_file (o ve lo aggiunge se l'archivio non lo ha).
+    Con allow_copy=False un file che non può essere collegato non viene copiato nell'archivio.
+    Ritorna il numero di byte risparmiati.
+    """
+    with store_lock:
+        if not os.path.exists(stored_file):
+            os.makedirs(os.path.dirname(stored_file), exist_ok=True)
+            if allow_copy:
+                link_or_copy(file_path, stored_file)
+            else:
+                os.link(file_path, stored_file)
+            return 0
+        if os.path.samefile(file_path, stored_file):
+            return 0
+        size = os.path.getsize(file_path)
+        temp_link = file_path + ".link"
+        try:
+            os.link(stored_file, temp_link)
+        except OSError:
+            return 0  # archivio su un altro disco: la copia locale resta com'è
+        os.replace(temp_link, file_path)  # sostituzione atomica del file duplicato
+        return size
+
+def store_track_file(final_file, track_info, output_folder):
+    """Registra il file finale nell'archivio centrale, per ID Spotify se noto, altrimenti per hash."""
+    try:
+        extension = Path(final_file).suffix.lower()
+        if track_info.get('id'):
+            stored_file = store_path_for("by-id", track_info['id'], extension)
+        else:
+            stored_file = store_path_for("by-hash", file_content_hash(final_file), extension)
+        fold_into_store(final_file, stored_file)
+    except OSError as e:
+        log_error(f"Track store error for {final_file}: {e}", output_folder)
+    return final_file
+
+#si occupa del comando dedup
+def dedup_library(folders=None):
+    """
+    Scansiona le cartelle (di default quelle delle playlist salvate), calcola l'hash di ogni file
+    a blocchi e sostituisce i duplicati identici con hardlink a un'unica copia nell'archivio.
+    """
+    if not track_store:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "TRACK_STORE is not set in the .env file.")
+        return
+    if folders is None:
+        _, folders = load_entries()
+    os.makedirs(track_store, exist_ok=True)
+    store_device = os.stat(track_store).st_dev
+    saved = 0
+    files = 0
+    for folder in dict.fromkeys(folders):  # stessa cartella una sola volta, nell'ordine originale
+        if not os.path.isdir(folder):
+            continue
+        # Su un altro disco gli hardlink non sono possibili: copiare nell'archivio raddoppierebbe lo spazio
+        if os.stat(folder).st_dev != store_device:
+            print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Skipping {folder}: it is not on the same disk as the track store.")
+            continue
+        for file in Path(folder).iterdir():
+            if not is_audio_file(file):
+                continue
+            try:
+                saved += fold_into_store(str(file), store_path_for("by-hash", file_content_hash(str(file)), file.suffix.lower()), allow_copy=False)
+                files += 1
+            except OSError as e:
+                log_error(f"Dedup error for {file}: {e}", folder)
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Scanned {files} files, {saved / (1024 * 1024):.1f} MB freed.")
+
+#Lock esclusivo su un file: serializza letture e scritture condivise anche tra processi/container diversi
+@contextmanager
+def path_lock(lock_path):
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+#Lock su file nella cartella: serializza le rinomine anche tra processi/container diversi
+def folder_lock(output_folder):
+    return path_lock(os.path.join(output_folder, FOLDER_LOCK_NAME))
+
 # === FASE 3: Rinomina del file ===
 def rename_file(temp_file, track_info, output_folder):
     """
@@ -362,14 +1915,16 @@ def rename_file(temp_file, track_info, output_folder):
     Ritorna il percorso finale del file.
     Implementa un meccanismo di retry se il file è in uso.
     """
+    started = time.monotonic()
     final_name = re.sub(r'[\/:*?."<>|]', " ", track_info['name']).strip().rstrip('.')
     final_output_path = Path(output_folder) / final_name
-    final_file = str(final_output_path) + codec
+    extension = Path(temp_file).suffix  # il formato del file finale è quello prodotto dal download
+    final_file = str(final_output_path) + extension
 
     max_retries = 5
     for attempt in range(max_retries):
         try:
-            with file_lock:
+            with file_lock, folder_lock(output_folder):
                 if not os.path.exists(final_file):
                     os.rename(temp_file, final_file)
                 else:
@@ -377,16 +1932,16 @@ def rename_file(temp_file, track_info, output_folder):
                     alt_final_name = f"{final_name} - {track_info['artists']}"
                     alt_final_name = re.sub(r'[\/:*?."<>|]', " ", alt_final_name).strip().rstrip('.')
                     alt_final_output_path = Path(output_folder) / alt_final_name
-                    alt_final_file = str(alt_final_output_path) + codec
+                    alt_final_file = str(alt_final_output_path) + extension
                     if not os.path.exists(alt_final_file):
                         os.rename(temp_file, alt_final_file)
                         final_file = alt_final_file
                     else:
                         # Fallback: aggiungi un suffisso numerico
                         i = 1
-                        while os.path.exists(f"{final_output_path}-{i}{codec}"):
+                        while os.path.exists(f"{final_output_path}-{i}{extension}"):
                             i += 1
-                        final_file = f"{final_output_path}-{i}{codec}"
+                        final_file = f"{final_output_path}-{i}{extension}"
                         os.rename(temp_file, final_file)
             break
         except OSError as e:
@@ -397,18 +1952,19 @@ def rename_file(temp_file, track_info, output_folder):
                 raise e
     else:
         print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Failed to rename {temp_file} after {max_retries} attempts.")
+        observe_stage("rename", time.monotonic() - started, ok=False)
         return None
 
     # Post-rinominazione: controlla che il nome del file corrisponda ai metadati
     try:
         if os.path.exists(final_file):
-            audio = MP3(final_file, ID3=EasyID3)
+            audio = open_audio_tags(final_file)
             metadata_title = audio.get('title', [final_name])[0]
             sanitized_title = re.sub(r'[\/:*?."<>|]', " ", metadata_title).strip().rstrip('.')
             current_name = Path(final_file).stem
             if sanitized_title != current_name:
                 new_final_output_path = Path(output_folder) / sanitized_title
-                new_final_file = str(new_final_output_path) + codec
+                new_final_file = str(new_final_output_path) + extension
                 if not os.path.exists(new_final_file):
                     os.rename(final_file, new_final_file)
                     final_file = new_final_file
@@ -416,58 +1972,385 @@ def rename_file(temp_file, track_info, output_folder):
                     print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Post-rename target already exists: {new_final_file}. Keeping original file.")
     except Exception as e:
         print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error in post-renaming check for {track_info['name']}: {e}")
-        error_file = os.path.join(output_folder, "Error.txt")
-        with open(error_file, 'a') as file:
-            file.write(f"[ERROR] Post-renaming check for {track_info['name']}: {e}\n")
-
+        queue_write("append", os.path.join(output_folder, "Error.txt"), f"[ERROR] Post-renaming check for {track_info['name']}: {e}\n")
+
+    # Aggiorna l'indice della cartella con il file finale appena prodotto
+    if track_store:
+        final_file = store_track_file(final_file, track_info, output_folder)
+    title, artist = get_file_metadata(final_file)
+    index_add_file(output_folder, final_file, title, artist)
+    mark_touched(output_folder, final_file)
+    observe_stage("rename", time.monotonic() - started)
     return final_file
 
 
-def finalize_track_processing(track):
+def processing_key(track, output_folder):
+    """
+    Chiave di in_processing: (cartella, titolo, artista). La cartella serve perché più lavori del demone
+    possono girare insieme: lo stesso brano per due cartelle diverse non deve far saltare il secondo.
+    """
+    return (os.path.normcase(os.path.abspath(output_folder)),) + normalize_key(track['name'], track['artists'])
+
+def finalize_track_processing(track, output_folder):
     """Rimuove la traccia dal set in_processing."""
-    key = (track['name'].strip().lower(), track['artists'].strip().lower())
-    in_processing.discard(key)
+    with in_processing_lock:
+        in_processing.discard(processing_key(track, output_folder))
 
 
 # === FASE 4: Verifica finale e correzione ===
-def phase4_verification(output_folder):
+def mark_touched(output_folder, file_path):
+    """Ricorda che file_path è stato prodotto o modificato durante questa esecuzione."""
+    with touched_lock:
+        touched_files.setdefault(os.path.abspath(output_folder), set()).add(os.path.abspath(file_path))
+
+def pop_touched_files(output_folder):
+    """Restituisce (e dimentica) i file toccati in questa esecuzione nella cartella."""
+    with touched_lock:
+        return touched_files.pop(os.path.abspath(output_folder), set())
+
+def load_bad_files(output_folder):
+    """Legge l'elenco persistente dei file che non hanno superato la verifica."""
+    try:
+        with open(os.path.join(output_folder, BAD_FILES_NAME), "r", encoding="utf-8") as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+def save_bad_files(output_folder, bad_files):
+    """Salva l'elenco dei file da ricontrollare; se è vuoto rimuove il file."""
+    bad_path = os.path.join(output_folder, BAD_FILES_NAME)
+    try:
+        if bad_files:
+            with open(bad_path, "w", encoding="utf-8") as f:
+                json.dump(sorted(bad_files), f, ensure_ascii=False)
+        elif os.path.exists(bad_path):
+            os.remove(bad_path)
+    except OSError as e:
+        log_error(f"Error saving verification state {bad_path}: {e}", output_folder)
+
+def verify_file(file, output_folder):
     """
-    Controlla tutti i file nella cartella di output:
-      - Per ogni file .mp3, se mancano i metadati (title o artist), li imposta:
-          * Usa il nome del file come title.
-          * Imposta "Unknown" come artist se mancante.
+    Controlla un singolo file: se mancano i metadati (title o artist), li imposta:
+      * Usa il nome del file come title.
+      * Imposta "Unknown" come artist se mancante.
+    Ritorna True se il file è valido (o è stato corretto), False se non è leggibile.
     """
-    for file in Path(output_folder).iterdir():
-        if not file.is_file():
-            continue
+    try:
+        audio = open_audio_tags(str(file))
+        title = audio.get('title', [None])[0]
+        artist = audio.get('artist', [None])[0]
+        changed = False
+        if not title:
+            default_title = file.stem
+            print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL +
+                  f"File {file} missing title. Setting title to '{default_title}'")
+            audio['title'] = default_title
+            changed = True
+        if not artist:
+            print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL +
+                  f"File {file} missing artist. Setting artist to 'Unknown'")
+            audio['artist'] = "Unknown"
+            changed = True
+        if changed:
+            detach_hardlink(str(file))  # mutagen riapre il file per nome: scrive sulla copia privata
+            audio.save()
+            index_add_file(output_folder, str(file), audio['title'][0], audio['artist'][0])
+        return True
+    except Exception as e:
+        log_error(f"Error processing file {file}: {e}", output_folder)
+        return False
 
-        # Processa solo i file con estensione .mp3
-        if file.suffix.lower() != ".mp3":
-            continue
+def phase4_verification(output_folder, full_scan=False):
+    """
+    Verifica i file della cartella di output con verify_file.
+    Di default è incrementale: controlla solo i file prodotti o modificati in questa esecuzione
+    più quelli che in passato non hanno superato la verifica. Con full_scan=True controlla
+    tutti i file della cartella, in parallelo.
+    """
+    known_bad = load_bad_files(output_folder)
+    if full_scan:
+        files = [file for file in Path(output_folder).iterdir() if file.is_file() and is_audio_file(file)]
+        pop_touched_files(output_folder)
+    else:
+        names = {Path(path).name for path in pop_touched_files(output_folder)} | known_bad
+        files = [Path(output_folder) / name for name in names]
+        files = [file for file in files if file.is_file()]  # i file spariti escono anche dall'elenco
+
+    if not files:
+        save_bad_files(output_folder, set())
+        return
+    with ThreadPoolExecutor(min(max_threads, len(files)) if full_scan else 1) as executor:
+        results = list(executor.map(lambda file: verify_file(file, output_folder), files))
+    save_bad_files(output_folder, {file.name for file, ok in zip(files, results) if not ok})
+
+#si occupa del comando verify
+def verify_folder(folder=None):
+    """Verifica completa (in parallelo) di una cartella; se non è indicata viene chiesta all'utente."""
+    if folder is None:
+        folder = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Enter the folder to verify: ").strip().strip('"').strip("'")
+    if not os.path.isdir(folder):
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{folder} does not exist")
+        return
+    phase4_verification(folder, full_scan=True)
+    save_folder_index(folder)
+    bad_files = load_bad_files(folder)
+    if bad_files:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{len(bad_files)} files could not be verified, see log.txt.")
+    else:
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "All files verified.")
+
+#Copia un file finale già pronto in un'altra cartella, con le stesse regole di nome di rename_file
+def place_track_copy(final_file, track_info, output_folder):
+    """
+    Copia il file finale di un brano in un'altra cartella di destinazione.
+    La copia passa da un nome temporaneo e poi da rename_file, così i nomi e l'indice
+    della cartella seguono le stesse regole dei file scaricati.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    temp_copy = str(Path(output_folder) / uuid.uuid4().hex) + Path(final_file).suffix
+    if track_store:
+        link_or_copy(final_file, temp_copy)  # con l'archivio centrale le cartelle condividono lo stesso file
+    else:
+        shutil.copy2(final_file, temp_copy)
+    return rename_file(temp_copy, track_info, output_folder)
+
+#Avanzamento di un download (usato dal demone per mostrare lo stato dei lavori)
+def report_progress(progress, field, amount=1):
+    """Incrementa un contatore di avanzamento; progress è un dict con "lock" oppure None."""
+    if progress is None:
+        return
+    with progress["lock"]:
+        progress[field] = progress.get(field, 0) + amount
+
+# === Modalità a fasi: ogni fase attende la fine della precedente ===
+def run_batch_phases(tracks, output_folder, progress=None):
+    """Esegue le fasi 1-3 (download, metadati, rinomina) una dopo l'altra su tutte le tracce."""
+    print("\n=== PHASE 1: Download tracks ===")
+    downloaded_items = []  # Lista di dict: { 'track': ..., 'temp_file': ... }
+    with ThreadPoolExecutor(max_threads) as executor:
+        future_to_track = {executor.submit(download_track, track, output_folder): track for track in tracks}
+        for future in as_completed(future_to_track):
+            track = future_to_track[future]
+            report_progress(progress, "processed")
+            try:
+                temp_file = future.result()
+                if temp_file:
+                    downloaded_items.append({"track": track, "temp_file": temp_file})
+                    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Downloaded: {track['name']} - Temp file: {temp_file}")
+            except Exception as e:
+                track_failed(output_folder, track, "download", f"Error downloading track {track['name']}: {e}", e)
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error downloading track {track['name']}: {e}")
+
+    print("\n=== PHASE 2: Adding metadata ===")
+    with ThreadPoolExecutor(max_threads) as executor:
+        future_to_item = {executor.submit(add_metadata_to_file, item["temp_file"], item["track"], output_folder): item for item in downloaded_items}
+        for future in as_completed(future_to_item):
+            item = future_to_item[future]
+            try:
+                success = future.result()
+                if success:
+                    journal_record(output_folder, item["track"], "tagged")
+                    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Metadata added for: {item['track']['name']}")
+                else:
+                    log_error(f"Error adding metadata for: {item['track']['name']}", output_folder)
+                    print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error adding metadata for: {item['track']['name']}")
+            except Exception as e:
+                log_error(f"Error adding metadata for {item['track']['name']}: {e}", output_folder)
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error adding metadata for {item['track']['name']}: {e}")
+
+    print("\n=== PHASE 3: Renaming files ===")
+    with ThreadPoolExecutor(max_threads) as executor:
+        future_to_item = {executor.submit(rename_file, item["temp_file"], item["track"], output_folder): item for item in downloaded_items}
+        for future in as_completed(future_to_item):
+            item = future_to_item[future]
+            try:
+                final_path = future.result()
+                if final_path:
+                    journal_record(output_folder, item["track"], "renamed", final_file=Path(final_path).name)
+                    report_progress(progress, "completed")
+                    count_metric("tracks_completed")
+                    track_succeeded(output_folder, item["track"])
+                    library_record_file(output_folder, item["track"], final_path)
+                else:
+                    track_failed(output_folder, item["track"], "rename", f"Error renaming file for {item['track']['name']}")
+                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"File for {item['track']['name']} renamed to: {final_path}")
+            except Exception as e:
+                track_failed(output_folder, item["track"], "rename", f"Error renaming file for {item['track']['name']}: {e}", e)
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error renaming file for {item['track']['name']}: {e}")
+            finally:
+                finalize_track_processing(item["track"], output_folder)
+
+
+# === Modalità pipeline: ogni traccia passa alla fase successiva appena è pronta ===
+def run_pipeline(tracks, output_folder, progress=None):
+    """
+    Esegue ricerca/download, metadati e rinomina in streaming: ogni traccia passa alla fase
+    successiva appena è pronta, attraverso code limitate tra una fase e l'altra.
+    Così i primi file arrivano subito nella cartella e i file temporanei presenti su disco
+    sono al massimo quelli che stanno nelle code.
+    """
+    run_pipeline_jobs([{"track": track, "folder": output_folder, "copies": []} for track in tracks], progress)
+
+def run_pipeline_jobs(jobs, progress=None):
+    """
+    Motore della pipeline. Ogni job è un dict {track, folder, copies}: il brano viene scaricato
+    una sola volta in folder e, dopo la rinomina, copiato in ognuna delle cartelle di copies.
+    """
+    track_queue = queue.Queue()
+    for job in jobs:
+        track_queue.put(job)
+    fetch_queue = queue.Queue(maxsize=pipeline_queue_size)
+    transcode_queue = queue.Queue(maxsize=pipeline_queue_size)
+    tag_queue = queue.Queue(maxsize=pipeline_queue_size)
+    rename_queue = queue.Queue(maxsize=pipeline_queue_size)
+
+    def stage_failed(job, stage, e):
+        track, output_folder = job["track"], job["folder"]
+        track_failed(output_folder, track, stage, f"Error downloading track {track['name']}: {e}", e)
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error downloading track {track['name']}: {e}")
+        finalize_track_processing(track, output_folder)
+        report_progress(progress, "processed")
+
+    def hand_to_tagger(job, temp_file):
+        report_progress(progress, "processed")
+        if temp_file:
+            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Downloaded: {job['track']['name']} - Temp file: {temp_file}")
+            tag_queue.put({"track": job["track"], "temp_file": temp_file, "folder": job["folder"], "copies": job["copies"]})  # si blocca se la coda è piena
+
+    def search_worker():
+        while True:
+            try:
+                job = track_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                step = prepare_download(job["track"], job["folder"])
+            except Exception as e:
+                stage_failed(job, "download", e)
+                continue
+            if step is None or "temp_file" in step:
+                hand_to_tagger(job, step and step["temp_file"])
+            else:
+                fetch_queue.put((job, step))
+
+    def fetch_worker():
+        while True:
+            item = fetch_queue.get()
+            if item is _PIPELINE_DONE:
+                return
+            job, step = item
+            try:
+                step = fetch_source(step)
+            except Exception as e:
+                stage_failed(job, "download", e)
+                continue
+            if step:
+                transcode_queue.put((job, step))
+            else:
+                report_progress(progress, "processed")
+
+    def transcode_worker():
+        while True:
+            item = transcode_queue.get()
+            if item is _PIPELINE_DONE:
+                return
+            job, step = item
+            try:
+                temp_file = transcode_source(step)
+            except Exception as e:
+                stage_failed(job, "transcode", e)
+                continue
+            hand_to_tagger(job, temp_file)
+
+    def tag_worker():
+        while True:
+            item = tag_queue.get()
+            if item is _PIPELINE_DONE:
+                return
+            output_folder = item["folder"]
+            try:
+                if add_metadata_to_file(item["temp_file"], item["track"], output_folder):
+                    journal_record(output_folder, item["track"], "tagged")
+                    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Metadata added for: {item['track']['name']}")
+                else:
+                    log_error(f"Error adding metadata for: {item['track']['name']}", output_folder)
+                    print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error adding metadata for: {item['track']['name']}")
+            except Exception as e:
+                log_error(f"Error adding metadata for {item['track']['name']}: {e}", output_folder)
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error adding metadata for {item['track']['name']}: {e}")
+            # Come nella modalità a fasi, il file viene rinominato anche se i metadati non sono stati scritti
+            rename_queue.put(item)
+
+    def rename_worker():
+        while True:
+            item = rename_queue.get()
+            if item is _PIPELINE_DONE:
+                return
+            output_folder = item["folder"]
+            try:
+                final_path = rename_file(item["temp_file"], item["track"], output_folder)
+                if final_path:
+                    journal_record(output_folder, item["track"], "renamed", final_file=Path(final_path).name)
+                    report_progress(progress, "completed")
+                    count_metric("tracks_completed")
+                    track_succeeded(output_folder, item["track"])
+                    library_record_file(output_folder, item["track"], final_path)
+                else:
+                    track_failed(output_folder, item["track"], "rename", f"Error renaming file for {item['track']['name']}")
+                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"File for {item['track']['name']} renamed to: {final_path}")
+            except Exception as e:
+                final_path = None
+                track_failed(output_folder, item["track"], "rename", f"Error renaming file for {item['track']['name']}: {e}", e)
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error renaming file for {item['track']['name']}: {e}")
+            finally:
+                finalize_track_processing(item["track"], output_folder)
+            # Ogni copia ha il suo esito: un errore va registrato nella cartella che resta senza file
+            for copy_folder in (item["copies"] if final_path else []):
+                try:
+                    copy_path = place_track_copy(final_path, item["track"], copy_folder)
+                except Exception as e:
+                    copy_path, error = None, e
+                else:
+                    error = None
+                if copy_path:
+                    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Copied {item['track']['name']} to: {copy_path}")
+                    track_succeeded(copy_folder, item["track"])
+                    library_record_file(copy_folder, item["track"], copy_path)
+                else:
+                    message = f"Error copying {item['track']['name']} to {copy_folder}" + (f": {error}" if error else "")
+                    track_failed(copy_folder, item["track"], "rename", message, error)
+                    print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + message)
+
+    # Ogni fase ha il suo gruppo di thread, dimensionato in modo indipendente dalle altre
+    search_pool = [threading.Thread(target=search_worker, daemon=True) for _ in range(search_threads)]
+    fetch_pool = [threading.Thread(target=fetch_worker, daemon=True) for _ in range(download_threads)]
+    transcode_pool = [threading.Thread(target=transcode_worker, daemon=True) for _ in range(transcode_threads)]
+    tag_threads = [threading.Thread(target=tag_worker, daemon=True) for _ in range(PIPELINE_TAG_WORKERS)]
+    rename_thread = threading.Thread(target=rename_worker, daemon=True)  # la rinomina è già serializzata da file_lock
+    for thread in search_pool + fetch_pool + transcode_pool + tag_threads + [rename_thread]:
+        thread.start()
+
+    # Chiusura ordinata: ogni fase riceve il segnale di fine solo quando la precedente ha finito
+    for thread in search_pool:
+        thread.join()
+    for _ in fetch_pool:
+        fetch_queue.put(_PIPELINE_DONE)
+    for thread in fetch_pool:
+        thread.join()
+    for _ in transcode_pool:
+        transcode_queue.put(_PIPELINE_DONE)
+    for thread in transcode_pool:
+        thread.join()
+    for _ in tag_threads:
+        tag_queue.put(_PIPELINE_DONE)
+    for thread in tag_threads:
+        thread.join()
+    rename_queue.put(_PIPELINE_DONE)
+    rename_thread.join()
 
-        try:
-            audio = MP3(str(file), ID3=EasyID3)
-            title = audio.get('title', [None])[0]
-            artist = audio.get('artist', [None])[0]
-            changed = False
-            if not title:
-                default_title = file.stem
-                print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL +
-                      f"File {file} missing title. Setting title to '{default_title}'")
-                audio['title'] = default_title
-                changed = True
-            if not artist:
-                print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL +
-                      f"File {file} missing artist. Setting artist to 'Unknown'")
-                audio['artist'] = "Unknown"
-                changed = True
-            if changed:
-                audio.save()
-        except Exception as e:
-            log_error(f"Error processing file {file}: {e}", output_folder)
 
 #si occupa del comando download
-def spotifydl(spotify_url, output_folder, flag):
+def spotifydl(spotify_url, output_folder, flag, tracks=None, progress=None):
     
             if not output_folder:
                 output_folder = "/app/downloads"
@@ -477,7 +2360,10 @@ def spotifydl(spotify_url, output_folder, flag):
             clear_terminal()
             
             # Estrae le tracce in base al tipo di URL e ne verifica la correttezza
-            if "playlist" in spotify_url:
+            if tracks is not None:
+                # Tracce già ottenute dal chiamante (es. solo quelle aggiunte dall'ultimo update)
+                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Tracks to process: {len(tracks)}")
+            elif "playlist" in spotify_url:
                 print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Extracting tracks from the playlist...")
                 tracks = get_spotify_playlist_tracks(spotify_url, 1)
                 if flag == 1:
@@ -490,7 +2376,7 @@ def spotifydl(spotify_url, output_folder, flag):
                 tracks = get_spotify_single_track(spotify_url)
             else:
                 print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Unsupported Spotify URL.")
-                return #in caso di errore esce dalla funzione
+                return False #in caso di errore esce dalla funzione
                 
             print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The songs will be saved in: {output_folder}")
 
@@ -503,127 +2389,262 @@ def spotifydl(spotify_url, output_folder, flag):
                     unique_tracks.append(track)
                     seen.add(key)
             tracks = unique_tracks
+            report_progress(progress, "total", len(tracks))
+
+            # Riallinea l'indice della cartella (rilegge solo i file nuovi o modificati)
+            load_folder_index(output_folder)
+            # Riprende le tracce interrotte e rimuove i file temporanei orfani
+            open_journal(output_folder)
 
-            print("\n=== PHASE 1: Download tracks ===")
-            downloaded_items = []  # Lista di dict: { 'track': ..., 'temp_file': ... }
-            with ThreadPoolExecutor(max_threads) as executor:
-                future_to_track = {executor.submit(download_track, track, output_folder): track for track in tracks}
-                for future in as_completed(future_to_track):
-                    track = future_to_track[future]
-                    try:
-                        temp_file = future.result()
-                        if temp_file:
-                            downloaded_items.append({"track": track, "temp_file": temp_file})
-                            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Downloaded: {track['name']} - Temp file: {temp_file}")
-                    except Exception as e:
-                        log_error(f"Error downloading track {track['name']}: {e}", output_folder)
-                        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error downloading track {track['name']}: {e}")
-
-            print("\n=== PHASE 2: Adding metadata ===")
-            with ThreadPoolExecutor(max_threads) as executor:
-                future_to_item = {executor.submit(add_metadata_to_file, item["temp_file"], item["track"], output_folder): item for item in downloaded_items}
-                for future in as_completed(future_to_item):
-                    item = future_to_item[future]
-                    try:
-                        success = future.result()
-                        if success:
-                            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Metadata added for: {item['track']['name']}")
-                        else:
-                            log_error(f"Error adding metadata for: {item['track']['name']}", output_folder)
-                            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error adding metadata for: {item['track']['name']}")
-                    except Exception as e:
-                        log_error(f"Error adding metadata for {item['track']['name']}: {e}", output_folder)
-                        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error adding metadata for {item['track']['name']}: {e}")
-
-            print("\n=== PHASE 3: Renaming files ===")
-            with ThreadPoolExecutor(max_threads) as executor:
-                future_to_item = {executor.submit(rename_file, item["temp_file"], item["track"], output_folder): item for item in downloaded_items}
-                for future in as_completed(future_to_item):
-                    item = future_to_item[future]
-                    try:
-                        final_path = future.result()
-                        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"File for {item['track']['name']} renamed to: {final_path}")
-                    except Exception as e:
-                        log_error(f"Error renaming file for {item['track']['name']}: {e}", output_folder)
-                        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error renaming file for {item['track']['name']}: {e}")
-                    finally:
-                        finalize_track_processing(item["track"])
+            if pipeline_mode:
+                print("\n=== PIPELINE: Search, download, tag and rename ===")
+                run_pipeline(tracks, output_folder, progress)
+            else:
+                run_batch_phases(tracks, output_folder, progress)
 
             print("\n=== PHASE 4: Final verification ===")
             phase4_verification(output_folder)
+            save_folder_index(output_folder)
+            save_search_cache()
+            close_journal(output_folder)
+            write_metrics()
+            flush_writes()
             clear_terminal()
+            return True
             
 
-def load_entries():
-    """Legge tutte le righe del file e salva spotify_url e output_folder in due liste."""
-    spotify_urls = []
-    output_folders = []
+#Libreria SQLite condivisa da tutti i comandi e processi (~/.SpotifyDl/library.db)
+LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS playlists (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,  -- ordine di salvataggio = numero mostrato da list
+    playlist_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    name TEXT,
+    snapshot_id TEXT,
+    complete INTEGER NOT NULL DEFAULT 0,
+    added_at REAL NOT NULL DEFAULT 0,
+    synced_at REAL,
+    UNIQUE (playlist_id, folder));
+CREATE TABLE IF NOT EXISTS tracks (
+    track_key TEXT PRIMARY KEY,  -- stessa chiave del giornale: id:<ID Spotify> oppure key:titolo|artista
+    spotify_id TEXT,
+    name TEXT NOT NULL,
+    artists TEXT NOT NULL,
+    album TEXT,
+    duration_ms INTEGER,
+    isrc TEXT,
+    youtube_id TEXT,
+    updated REAL NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc);
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    playlist INTEGER NOT NULL REFERENCES playlists (id) ON DELETE CASCADE,
+    track_key TEXT NOT NULL,
+    PRIMARY KEY (playlist, track_key));
+CREATE TABLE IF NOT EXISTS files (
+    folder TEXT NOT NULL,
+    track_key TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    updated REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (folder, track_key));
+CREATE INDEX IF NOT EXISTS files_track ON files (track_key);
+"""
 
-    if not os.path.exists(DATA_FILE):
-        return spotify_urls, output_folders  # Se il file non esiste, ritorna liste vuote
+def library_connect():
+    """
+    Restituisce la connessione alla libreria del thread corrente. La modalità WAL permette ai lettori
+    (list, update, altri processi) di non bloccare chi scrive. Alla prima apertura nel processo crea
+    le tabelle e importa data.dat e sync_state.json, se esistono ancora.
+    """
+    global library_ready
+    conn = getattr(library_local, "conn", None)
+    if conn is None:
+        os.makedirs(CONFIG_FOLDER, exist_ok=True)
+        conn = sqlite3.connect(LIBRARY_DB, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # con WAL resta consistente anche dopo un crash
+        conn.execute("PRAGMA foreign_keys=ON")
+        library_local.conn = conn
+    if not library_ready:
+        with library_lock:
+            if not library_ready:
+                conn.executescript(LIBRARY_SCHEMA)
+                import_legacy_files(conn)
+                library_ready = True
+    return conn
+
+def import_legacy_files(conn):
+    """Importa il vecchio data.dat (righe "url cartella") e sync_state.json, poi li rinomina in .bak."""
+    imported = []
+    conn.execute("BEGIN IMMEDIATE")  # un altro processo che importa nello stesso momento aspetta qui
+    try:
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, "r", encoding="utf-8") as file:
+                for line in file:
+                    parts = line.strip().split(" ", 1)  # Divide in due parti: URL e cartella
+                    if len(parts) == 2 and "playlist" in parts[0]:
+                        _upsert_playlist(conn, parts[0], parts[1])
+            imported.append(DATA_FILE)
+        if os.path.exists(SYNC_STATE_FILE):
+            try:
+                with open(SYNC_STATE_FILE, "r", encoding="utf-8") as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {}
+            for key, entry in state.items():
+                playlist_id, _, folder = key.partition(" ")
+                row = conn.execute("SELECT id FROM playlists WHERE playlist_id = ? AND folder = ?", (playlist_id, folder)).fetchone()
+                if row:
+                    tracks = [{'id': track_id, 'name': name, 'artists': artists} for track_id, (name, artists) in entry.get("tracks", {}).items()]
+                    _store_sync_state(conn, row[0], entry.get("snapshot_id"), tracks, entry.get("complete", False), None)
+            imported.append(SYNC_STATE_FILE)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for path in imported:
+        os.replace(path, path + ".bak")
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{os.path.basename(path)} imported into {LIBRARY_DB}")
+
+def _upsert_playlist(conn, url, folder, name=None):
+    """Aggiunge la playlist (o aggiorna link e nome se la coppia playlist/cartella c'è già); ritorna il suo id."""
+    playlist_id = url.split("/")[-1].split("?")[0]
+    folder = os.path.abspath(folder)
+    conn.execute("""INSERT INTO playlists (playlist_id, url, folder, name, added_at) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (playlist_id, folder) DO UPDATE SET url = excluded.url, name = COALESCE(excluded.name, name)""",
+                 (playlist_id, url, folder, name, time.time()))
+    return conn.execute("SELECT id FROM playlists WHERE playlist_id = ? AND folder = ?", (playlist_id, folder)).fetchone()[0]
+
+def _upsert_track(conn, track, youtube_url=None):
+    """Salva i dati del brano; un ID di YouTube già noto resta se non ne arriva uno nuovo."""
+    key = journal_key(track)
+    youtube_id = None
+    if youtube_url:
+        match = re.search(r"(?:v=|youtu\.be/|shorts/)([\w-]{11})", youtube_url)
+        youtube_id = match.group(1) if match else youtube_url
+    conn.execute("""INSERT INTO tracks (track_key, spotify_id, name, artists, album, duration_ms, isrc, youtube_id, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (track_key) DO UPDATE SET name = excluded.name, artists = excluded.artists,
+            album = COALESCE(excluded.album, album), duration_ms = COALESCE(excluded.duration_ms, duration_ms),
+            isrc = COALESCE(excluded.isrc, isrc), youtube_id = COALESCE(excluded.youtube_id, youtube_id),
+            updated = excluded.updated""",
+                 (key, track.get('id'), track['name'], track['artists'], track.get('album'), track.get('duration_ms'),
+                  track.get('isrc'), youtube_id, time.time()))
+    return key
+
+def library_record_track(track, youtube_url=None):
+    """Registra il brano e il video di YouTube scelto per scaricarlo."""
+    conn = library_connect()
+    _upsert_track(conn, track, youtube_url)
+
+def library_youtube_url(track):
+    """Ritorna l'URL del video di YouTube registrato per il brano, o None."""
+    row = library_connect().execute("SELECT youtube_id FROM tracks WHERE track_key = ?", (journal_key(track),)).fetchone()
+    if not row or not row[0]:
+        return None
+    return row[0] if "://" in row[0] else f"https://www.youtube.com/watch?v={row[0]}"
 
-    with open(DATA_FILE, "r") as file:
-        for line in file:
-            parts = line.strip().split(" ", 1)  # Divide in due parti: URL e cartella
-            if len(parts) == 2:
-                spotify_urls.append(parts[0])
-                output_folders.append(parts[1])
+def library_forget_youtube(track):
+    """Dimentica il video registrato per il brano (es. dopo un errore di download)."""
+    library_connect().execute("UPDATE tracks SET youtube_id = NULL WHERE track_key = ?", (journal_key(track),))
 
-    return spotify_urls, output_folders
+def library_find_file(track, output_folder):
+    """
+    Cerca nella libreria il file finale dello stesso brano in un'altra cartella. Un file viene usato solo se
+    esiste ancora e i suoi tag corrispondono al brano; le righe che non corrispondono più vengono eliminate.
+    """
+    conn = library_connect()
+    key = journal_key(track)
+    wanted = normalize_key(track['name'], track['artists'])
+    rows = conn.execute("SELECT folder, file_name FROM files WHERE track_key = ? AND folder != ?",
+                        (key, os.path.abspath(output_folder))).fetchall()
+    for folder, file_name in rows:
+        file_path = os.path.join(folder, file_name)
+        if os.path.isfile(file_path):
+            title, artist = get_file_metadata(file_path)
+            if title and artist and normalize_key(title, artist) == wanted:
+                return file_path
+        conn.execute("DELETE FROM files WHERE folder = ? AND track_key = ?", (folder, key))
+    return None
 
-#La funzione ha lo scopo di assicurarsi che non ci siano ripetizioni in data.dat
+def library_forget_file(output_folder, file_name):
+    """Toglie dalla libreria un file finale spostato o eliminato."""
+    library_connect().execute("DELETE FROM files WHERE folder = ? AND file_name = ?", (os.path.abspath(output_folder), file_name))
+
+def library_record_file(output_folder, track, final_path):
+    """Registra il file finale di un brano in una cartella (una riga per brano e cartella)."""
+    conn = library_connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        key = _upsert_track(conn, track)
+        conn.execute("""INSERT INTO files (folder, track_key, file_name, updated) VALUES (?, ?, ?, ?)
+            ON CONFLICT (folder, track_key) DO UPDATE SET file_name = excluded.file_name, updated = excluded.updated""",
+                     (os.path.abspath(output_folder), key, Path(final_path).name, time.time()))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def load_entries():
+    """Restituisce i link e le cartelle delle playlist salvate, nell'ordine in cui sono state aggiunte."""
+    rows = library_connect().execute("SELECT url, folder FROM playlists ORDER BY id").fetchall()
+    return [url for url, _ in rows], [folder for _, folder in rows]
+
+#La funzione ha lo scopo di togliere dalla libreria le playlist non più raggiungibili
 def clean_entries():
     """
-    Rimuove dal file data.dat le voci con cartelle non più esistenti e quelle playlist
-    il cui link non è più valido. Se il link della playlist non è valido, stampa il percorso associato.
+    Rimuove dalla libreria le playlist con cartelle non più esistenti e quelle il cui link
+    non è più valido (stampando il percorso associato); aggiorna il nome di quelle valide.
     """
-    spotify_urls, output_folders = load_entries()
-    
-    # Configurazione dell'accesso all'API di Spotify (assicurarsi che client_id e client_secret siano definiti)
-    auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-    sp = spotipy.Spotify(auth_manager=auth_manager)
-    
+    conn = library_connect()
+    rows = conn.execute("SELECT id, url, folder, playlist_id FROM playlists ORDER BY id").fetchall()
+
     valid_entries = []
+    candidates = []
+    removed = []
     
-    for url, folder in zip(spotify_urls, output_folders):
+    for row_id, url, folder, playlist_id in rows:
         # Se la cartella non esiste, salta la voce
         if not os.path.exists(folder):
+            removed.append(row_id)
             continue
         
-        # Estrae l'ID della playlist dall'URL
-        playlist_id = None
-        if "playlist/" in url:
-            playlist_id = url.split("playlist/")[1].split('?')[0]
-        
-        # Se non riesco a estrarre un ID valido, o se il link non è più valido, stampa un messaggio e salta la voce
-        if not playlist_id:
+        # Se non riesco a estrarre un ID valido stampa un messaggio e salta la voce
+        if "playlist/" not in url or not playlist_id:
             print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The link is no longer valid for the path: {folder}")
+            removed.append(row_id)
             continue
         
-        try:
-            sp.playlist(playlist_id)
-        except Exception:
+        candidates.append((row_id, url, folder, playlist_id))
+
+    # Verifica i link in parallelo (l'ordine delle voci resta quello della libreria)
+    infos = fetch_playlists_info([playlist_id for _, _, _, playlist_id in candidates], "id,name")
+    names = []
+    for (row_id, url, folder, _), info in zip(candidates, infos):
+        if info is None:
             print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The link is no longer valid for the directory: {folder}")
+            removed.append(row_id)
             continue
-        
+        if not info:
+            print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Could not reach Spotify for the directory: {folder}, keeping it")
+        names.append((info.get('name'), row_id))
         valid_entries.append((url, folder))
     
-    # Riscrive il file data.dat con solo le voci valide
-    with open(DATA_FILE, "w") as file:
-        for url, folder in valid_entries:
-            file.write(f"{url} {folder}\n")
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany("DELETE FROM playlists WHERE id = ?", [(row_id,) for row_id in removed])
+    conn.executemany("UPDATE playlists SET name = COALESCE(?, name) WHERE id = ?", names)
+    conn.execute("COMMIT")
     
     return valid_entries
 
-#Scrive spotify_url e output_folder nel file data.dat, aggiungendo alla fine se esiste già. 
+#Salva spotify_url e output_folder nella libreria; la stessa playlist nella stessa cartella compare una sola volta
 def save_entry(spotify_url, output_folder):
-    
-    with open(DATA_FILE, "a") as file:
-        file.write(f"{spotify_url} {output_folder}\n")
+    playlist_id = spotify_url.split("/")[-1].split("?")[0]
+    _upsert_playlist(library_connect(), spotify_url, output_folder, playlist_names.get(playlist_id))
 
 
 def has_content(file):
-    """Restituisce 1 se il file data.dat contiene dati, altrimenti 0."""
+    """Restituisce 1 se il file contiene dati, 0 se non esiste, 3 se è vuoto."""
     if not os.path.exists(file):
         return 0  # Il file non esiste, quindi è vuoto
 
@@ -637,9 +2658,9 @@ def has_content(file):
 
 
 def get_file_metadata(mp3_file):
-    """Legge il titolo e l'artista dal metadato ID3 del file MP3."""
+    """Legge il titolo e l'artista dai metadati del file audio (ID3, MP4 o commenti Vorbis)."""
     try:
-        audio = MP3(mp3_file, ID3=EasyID3)
+        audio = open_audio_tags(mp3_file)
         title = audio.get("title", [None])[0]  # Prende il primo valore della lista
         artist = audio.get("artist", [None])[0]  # Prende il primo valore della lista
         return title, artist  # Restituisce una tupla con titolo e artista
@@ -647,108 +2668,480 @@ def get_file_metadata(mp3_file):
         return None, None  # Se non può leggere i metadati, restituisce None per entrambi
 
     
-def check_playlist_files(playlist_url, folder):
-    """Controlla se i file della cartella corrispondono ai brani della playlist."""
-    # Ottieni la lista dei brani tramite la funzione aggiornata
-    playlist_tracks_dict = get_spotify_playlist_tracks(playlist_url,0)
-    found_tracks_lower = set()
-    
-    for file in os.listdir(folder):
-        if file.endswith(".mp3"):
-            file_path = os.path.join(folder, file)
-            track_title, track_artist = get_file_metadata(file_path)
-            
-            if track_title:
-                track_title_lower = track_title.lower()
-                # Confronta il nome del file con i titoli della playlist ottenuti dalle API di Spotify
-                match = next((track for track in playlist_tracks_dict 
-              if track['name'].lower() == track_title_lower and track['artists'].lower() == track_artist.lower()), None)
+def build_sync_plan(playlist_tracks, folder):
+    """
+    Confronta i brani della playlist con i file della cartella usando dizionari indicizzati per
+    (titolo, artista) normalizzati, letti dall'indice della cartella (nessun file viene riletto).
+    Restituisce il piano: brani da scaricare, file da eliminare, file invariati, file senza titolo
+    e file con titolo ma senza artista ("unknown"): questi ultimi non si possono confrontare con la
+    playlist, quindi non vengono mai eliminati.
+    """
+    index = load_folder_index(folder)
+    wanted = {normalize_key(track['name'], track['artists']): track for track in playlist_tracks}
+
+    plan = {"folder": folder, "download": [], "delete": [], "unchanged": [], "untagged": [], "unknown": []}
+    with index_lock:
+        files = dict(index["files"])
+        present_keys = set(index["keys"])
+    for file_name, entry in sorted(files.items()):
+        if not entry.get("title"):
+            plan["untagged"].append(file_name)
+        elif not entry.get("artist"):
+            plan["unknown"].append(file_name)
+        elif normalize_key(entry["title"], entry["artist"]) in wanted:
+            plan["unchanged"].append(file_name)
+        else:
+            plan["delete"].append(file_name)
+    for key, track in wanted.items():
+        if key not in present_keys:
+            plan["download"].append({"id": track.get('id'), "name": track['name'], "artists": track['artists']})
+    return plan
 
-                
-                if match:
-                    found_tracks_lower.add(track_title_lower)
-                else:
-                    choice = input(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + 
-                                   f"The song '{file}' is not in the playlist. Do you want to delete it? (y/n): ").strip().lower()
-                    if choice == "y":
-                        os.remove(file_path)
-                        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Song '{file}' deleted.")
-                        clear_terminal()
-                            
+def apply_sync_plan(plan, policy):
+    """
+    Applica in un'unica passata le eliminazioni del piano secondo la politica scelta:
+    "keep" lascia i file, "delete" li elimina, "trash" li sposta nella cartella .trash.
+    """
+    folder = plan["folder"]
+    if policy == "keep" or not plan["delete"]:
+        return
+    trash_folder = os.path.join(folder, TRASH_FOLDER_NAME)
+    for file_name in plan["delete"]:
+        file_path = os.path.join(folder, file_name)
+        try:
+            if policy == "trash":
+                os.makedirs(trash_folder, exist_ok=True)
+                shutil.move(file_path, os.path.join(trash_folder, file_name))
+                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Song '{file_name}' moved to {trash_folder}.")
             else:
-                print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + 
-                      f"The file '{file}' does not have a title metadata. I recommend adding it.")
-
-    missing_tracks = [track['name'] for track in playlist_tracks_dict if track['name'].lower() not in found_tracks_lower]
-
-    if missing_tracks:
+                os.remove(file_path)
+                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Song '{file_name}' deleted.")
+            index_remove_file(folder, file_path)
+            library_forget_file(folder, file_name)
+        except OSError as e:
+            log_error(f"Error removing {file_path}: {e}", folder)
+    save_folder_index(folder)
+
+def print_sync_plan(plan):
+    """Stampa il piano di sincronizzazione in forma leggibile."""
+    if plan["delete"]:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "These songs are not in the playlist:")
+        for file_name in plan["delete"]:
+            print(f"   - {file_name}")
+    for file_name in plan["untagged"]:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + 
+              f"The file '{file_name}' does not have a title metadata. I recommend adding it.")
+    for file_name in plan["unknown"]:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL +
+              f"The file '{file_name}' does not have an artist metadata, so it is kept. I recommend adding it.")
+    if plan["download"]:
         print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "These songs are missing from the folder:")
-        for track in missing_tracks:
+        for track in plan["download"]:
             print(f"   - {track['name']} by {track['artists']}")
+
+def check_playlist_files(playlist_url, folder, playlist_tracks=None, policy=None, as_json=False):
+    """
+    Controlla se i file della cartella corrispondono ai brani della playlist e applica il piano
+    di sincronizzazione senza chiedere nulla all'utente.
+    Se il chiamante ha già la lista dei brani la può passare, evitando di richiederla di nuovo a Spotify.
+    policy è "keep", "delete" o "trash" (di default SYNC_POLICY); con as_json=True il piano viene
+    solo stampato in JSON e nessun file viene toccato.
+    Restituisce il piano.
+    """
+    # Ottieni la lista dei brani tramite la funzione aggiornata
+    playlist_tracks = playlist_tracks if playlist_tracks is not None else get_spotify_playlist_tracks(playlist_url,0)
+    plan = build_sync_plan(playlist_tracks, folder)
+    if as_json:
+        print(json.dumps(plan, ensure_ascii=False, indent=2))
+        return plan
+    print_sync_plan(plan)
+    apply_sync_plan(plan, policy or sync_policy)
+    return plan
+
+#si occupa del comando plan
+def show_sync_plan(playlist_number, apply=False, policy=None):
+    """
+    Stampa in JSON il piano di sincronizzazione di una playlist salvata. Con apply=True il piano
+    viene poi applicato in un'unica passata secondo policy (di default SYNC_POLICY).
+    Ritorna il codice di uscita.
+    """
+    spotify_urls, output_folders = load_entries()
+    if not 1 <= playlist_number <= len(spotify_urls):
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid playlist number.")
+        return EXIT_USAGE
+    url, folder = spotify_urls[playlist_number - 1], output_folders[playlist_number - 1]
+    plan = check_playlist_files(url, folder, as_json=True)
+    if apply:
+        apply_sync_plan(plan, policy or sync_policy)
+    return EXIT_OK
+
+#Stato dell'ultima sincronizzazione di ogni playlist salvata (snapshot_id e brani presenti), nella libreria
+def load_sync_state(playlist_id, folder):
+    """
+    Ritorna lo stato dell'ultima sincronizzazione di una playlist ({"snapshot_id", "complete",
+    "tracks": {ID: [titolo, artista]}}) oppure None se non è mai stata sincronizzata.
+    """
+    conn = library_connect()
+    row = conn.execute("SELECT id, snapshot_id, complete FROM playlists WHERE playlist_id = ? AND folder = ?",
+                       (playlist_id, os.path.abspath(folder))).fetchone()
+    if not row or row[1] is None:
+        return None
+    tracks = conn.execute("""SELECT t.spotify_id, t.name, t.artists FROM playlist_tracks p
+        JOIN tracks t ON t.track_key = p.track_key WHERE p.playlist = ?""", (row[0],)).fetchall()
+    return {"snapshot_id": row[1], "complete": bool(row[2]),
+            "tracks": {track_id: [name, artists] for track_id, name, artists in tracks if track_id}}
+
+def _store_sync_state(conn, row_id, snapshot_id, tracks, complete, synced_at):
+    """Sostituisce i brani sincronizzati della playlist; va chiamata dentro una transazione."""
+    conn.execute("UPDATE playlists SET snapshot_id = ?, complete = ?, synced_at = ? WHERE id = ?",
+                 (snapshot_id, 1 if complete else 0, synced_at, row_id))
+    conn.execute("DELETE FROM playlist_tracks WHERE playlist = ?", (row_id,))
+    conn.executemany("INSERT OR IGNORE INTO playlist_tracks (playlist, track_key) VALUES (?, ?)",
+                     [(row_id, _upsert_track(conn, track)) for track in tracks])
+
+def save_sync_state(plan, tracks, complete):
+    """Registra in un'unica transazione snapshot_id, nome e brani presenti di una playlist sincronizzata."""
+    conn = library_connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row_id = _upsert_playlist(conn, plan["url"], plan["folder"], plan.get("name"))
+        _store_sync_state(conn, row_id, plan["snapshot_id"], tracks, complete, time.time())
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+def plan_playlist_sync(url, folder, in_worker=False):
+    """
+    Confronta una playlist salvata con l'ultima sincronizzazione usando lo snapshot_id di Spotify.
+    Se la playlist non è cambiata e tutti i suoi brani sono ancora nella cartella, costa una sola
+    richiesta leggera (piano con skip=True). Altrimenti scarica la lista dei brani una volta e
+    calcola quali sono stati aggiunti dall'ultima sincronizzazione.
+    in_worker viene passato a get_spotify_playlist_tracks quando i piani sono calcolati in parallelo.
+    """
+    if "playlist" in url:
+        playlist_id = url.split("/")[-1].split("?")[0]
     else:
-        return
+        raise ValueError("Invalid playlist URL")
 
+    playlist_info = call_with_backoff("spotify", get_spotify_client().playlist, playlist_id, fields="name,snapshot_id")
+    plan = {"url": url, "folder": folder, "playlist_id": playlist_id, "name": playlist_info['name'],
+            "snapshot_id": playlist_info['snapshot_id'], "skip": False, "tracks": [], "added": []}
+    previous = load_sync_state(playlist_id, folder)
+
+    if previous and previous.get("complete") and previous.get("snapshot_id") == plan["snapshot_id"] and os.path.isdir(folder):
+        # L'indice della cartella si riallinea solo con stat(): nessun file viene riletto se non è cambiato
+        index = load_folder_index(folder)
+        if all(normalize_key(title, artist) in index["keys"] for title, artist in previous.get("tracks", {}).values()):
+            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{plan['name']} has not changed, skipping.")
+            plan["skip"] = True
+            return plan
+
+    tracks = get_spotify_playlist_tracks(url, 0, in_worker=in_worker)
+    if previous:
+        known_ids = set(previous.get("tracks", {}))
+        current_ids = {track['id'] for track in tracks if track.get('id')}
+        new_tracks = [track for track in tracks if not track.get('id') or track['id'] not in known_ids]
+        # Anche i brani già sincronizzati il cui file è stato cancellato vanno riscaricati subito
+        folder_exists = os.path.isdir(folder)
+        missing = [track for track in tracks if track.get('id') in known_ids
+                   and (not folder_exists or not track_already_downloaded(track, folder))]
+        added = new_tracks + missing
+        removed = known_ids - current_ids
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{plan['name']}: {len(new_tracks)} added, {len(removed)} removed since the last update, {len(missing)} missing from the folder.")
+    else:
+        added = tracks
+    plan["tracks"] = tracks
+    plan["added"] = added
+    return plan
 
-    # Trova i brani mancanti utilizzando il confronto normalizzato
-    missing_tracks = [original for lower, original in playlist_tracks_dict.items() if lower not in found_tracks_lower]
-    if missing_tracks:
-        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "These songs are missing from the folder:")
-        for track in missing_tracks:
-            print(f"   - {track}")
-        return
+def finish_playlist_sync(plan, policy=None):
+    """
+    Controlla la cartella rispetto alla playlist (applicando policy, di default SYNC_POLICY)
+    e registra lo stato della sincronizzazione.
+    """
+    url, folder, tracks = plan["url"], plan["folder"], plan["tracks"]
+    check_playlist_files(url, folder, tracks, policy=policy)
 
-#si occupa del comando update
-def update(playlist_number):
+    # Registra solo i brani effettivamente presenti: quelli falliti verranno ritentati al prossimo update
+    synced = [track for track in tracks if track.get('id') and track_already_downloaded(track, folder)]
+    complete = len({track['id'] for track in synced}) == len({track['id'] for track in tracks if track.get('id')})
+    save_sync_state(plan, synced, complete)
 
-    if playlist_number == 0:   #aggiorna tutte le playlist
-        result = has_content(DATA_FILE)
-        if result == 1:
-            valid_entries = clean_entries()
-            for url, folder in valid_entries:
-                spotifydl(url, folder, 0)
-                check_playlist_files(url, folder)
-                
-                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Update complete!")
-            return
-        elif result == 3:
-            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The playlist database is corrupted.")
-        elif result == 0:
-            print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"No playlist has been downloaded yet.")
-        else:
-            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Unexpected error.")
-    else: #aggiorna la playlist playlist_number
+def sync_playlist(url, folder, policy=None):
+    """
+    Aggiorna una playlist salvata scaricando solo i brani aggiunti dall'ultima sincronizzazione.
+    Ritorna il nome della playlist.
+    """
+    plan = plan_playlist_sync(url, folder)
+    if not plan["skip"]:
+        spotifydl(url, folder, 0, tracks=plan["added"])
+        finish_playlist_sync(plan, policy)
+    return plan["name"]
+
+def update_all_shared(entries, policy=None):
+    """
+    Aggiorna tutte le playlist salvate con un unico scheduler condiviso.
+    I piani delle playlist vengono calcolati in parallelo, poi ogni brano unico viene cercato e
+    scaricato una sola volta e copiato in tutte le cartelle che ne hanno bisogno: il lavoro
+    cresce con il numero di brani unici, non con la somma delle dimensioni delle playlist.
+    """
+    def plan_entry(entry):
+        url, folder = entry
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as file:
-                lines = file.readlines()
-                
-                if 1 <= playlist_number <= len(lines):
-                    line = lines[playlist_number - 1].strip()
-                    parts = line.split(" ", 1)  # Split only at the first space
-                    
-                    if len(parts) == 2:
-                        url, folder = parts
-                        spotifydl(url, folder, 0) #update
-                        check_playlist_files(url, folder)
-
-                        #stampa il nome della playlist
-                        auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-                        sp = spotipy.Spotify(auth_manager=auth_manager)
-                        if "playlist" in url:
-                            playlist_id = url.split("/")[-1].split("?")[0]
-                        else:
-                            raise ValueError("Invalid playlist URL")
-                        
-                        playlist_info = sp.playlist(playlist_id)
-                        playlist_name = playlist_info['name']
-                        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{playlist_name} is now updated") #stampa il nome
+            return plan_playlist_sync(url, folder, in_worker=True)
+        except Exception as e:
+            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Error reading playlist {url}: {e}")
+            return None
+
+    if not entries:
+        return
+    with ThreadPoolExecutor(min(spotify_fanout, len(entries))) as executor:
+        plans = [plan for plan in executor.map(plan_entry, entries) if plan and not plan["skip"]]
+
+    # Raggruppa i brani mancanti per brano unico: ID Spotify, oppure (titolo, artista).
+    # Anche due ID diversi con lo stesso (titolo, artista) finiscono nello stesso lavoro: il file
+    # viene scaricato una volta sola e copiato nelle altre cartelle
+    jobs = {}
+    jobs_by_name = {}
+    for plan in plans:
+        folder = plan["folder"]
+        os.makedirs(folder, exist_ok=True)
+        load_folder_index(folder)
+        open_journal(folder)
+        for track in plan["added"]:
+            if track_already_downloaded(track, folder):
+                continue
+            name_key = normalize_key(track['name'], track['artists'])
+            job_key = track.get('id') or name_key
+            job = jobs.get(job_key) or jobs_by_name.get(name_key)
+            if job is None:
+                job = jobs[job_key] = {"track": track, "folder": folder, "copies": []}
+                jobs_by_name[name_key] = job
+            elif folder != job["folder"] and folder not in job["copies"]:
+                job["copies"].append(folder)
+
+    total_needed = sum(1 + len(job["copies"]) for job in jobs.values())
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{len(plans)} playlists changed: {len(jobs)} unique tracks to download for {total_needed} placements.")
+    run_pipeline_jobs(list(jobs.values()))
+
+    for plan in plans:
+        phase4_verification(plan["folder"])
+        save_folder_index(plan["folder"])
+        close_journal(plan["folder"])
+        finish_playlist_sync(plan, policy)
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{plan['name']} is now updated")
+    save_search_cache()
+    write_metrics()
+
+#Coda di lavori condivisa (SQLite nella cartella di output): più processi o container si dividono i brani
+def queue_connect(output_folder):
+    """Apre una connessione alla coda della cartella (una per thread) e crea la tabella se manca."""
+    conn = sqlite3.connect(os.path.join(output_folder, QUEUE_DB_NAME), timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+        job_key TEXT PRIMARY KEY,
+        track TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        owner TEXT,
+        lease_until REAL NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        updated REAL NOT NULL DEFAULT 0)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+    return conn
+
+def enqueue_tracks(output_folder, tracks):
+    """
+    Aggiunge le tracce alla coda; quelle già presenti (stessa chiave) vengono ignorate, tranne quelle
+    fallite dopo QUEUE_MAX_ATTEMPTS tentativi, che tornano in attesa con i tentativi azzerati.
+    Ritorna quante tracce sono state messe (o rimesse) in coda.
+    """
+    conn = queue_connect(output_folder)
+    try:
+        before = conn.total_changes
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("""INSERT INTO jobs (job_key, track, updated) VALUES (?, ?, ?)
+            ON CONFLICT (job_key) DO UPDATE SET status = 'pending', attempts = 0, owner = NULL, lease_until = 0,
+                track = excluded.track, updated = excluded.updated
+            WHERE status = 'failed'""",
+                         [(journal_key(track), json.dumps(track, ensure_ascii=False), time.time()) for track in tracks])
+        conn.execute("COMMIT")
+        return conn.total_changes - before
+    finally:
+        conn.close()
+
+def claim_job(conn, worker_id):
+    """
+    Prende in carico un lavoro libero (o con la lease scaduta perché il suo worker è morto).
+    La transazione IMMEDIATE blocca gli altri processi, quindi due worker non prendono lo stesso lavoro.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Un lavoro il cui worker è morto a ogni tentativo (es. crash su quel brano) non va ripreso all'infinito
+        conn.execute("""UPDATE jobs SET status = 'failed', owner = NULL, lease_until = 0, updated = ?
+            WHERE status = 'leased' AND lease_until < ? AND attempts >= ?""", (now, now, QUEUE_MAX_ATTEMPTS))
+        row = conn.execute("""SELECT job_key, track FROM jobs
+            WHERE (status = 'pending' OR (status = 'leased' AND lease_until < ?)) AND attempts < ?
+            ORDER BY attempts, rowid LIMIT 1""", (now, QUEUE_MAX_ATTEMPTS)).fetchone()
+        if row:
+            conn.execute("UPDATE jobs SET status = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE job_key = ?",
+                         (worker_id, now + QUEUE_LEASE_SECONDS, now, row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return (row[0], json.loads(row[1])) if row else None
+
+def finish_job(conn, job_key, worker_id, success):
+    """Segna il lavoro come completato; se è fallito torna in coda finché non supera i tentativi massimi."""
+    conn.execute("""UPDATE jobs SET
+        status = CASE WHEN ? THEN 'done' WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+        owner = NULL, lease_until = 0, updated = ?
+        WHERE job_key = ? AND owner = ?""", (1 if success else 0, QUEUE_MAX_ATTEMPTS, time.time(), job_key, worker_id))
+
+def queue_has_pending(conn):
+    """True se ci sono ancora lavori da fare o in corso presso altri worker."""
+    return conn.execute("SELECT 1 FROM jobs WHERE status IN ('pending', 'leased') LIMIT 1").fetchone() is not None
+
+def process_queue_job(track, output_folder):
+    """Esegue tutte le fasi per un singolo brano preso dalla coda. Ritorna True se il file finale esiste."""
+    temp_file = download_track(track, output_folder)
+    if not temp_file:
+        return track_already_downloaded(track, output_folder)
+    try:
+        if add_metadata_to_file(temp_file, track, output_folder):
+            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Metadata added for: {track['name']}")
+        final_path = rename_file(temp_file, track, output_folder)
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"File for {track['name']} renamed to: {final_path}")
+        if final_path:
+            track_succeeded(output_folder, track)
+            library_record_file(output_folder, track, final_path)
+        return final_path is not None
+    finally:
+        finalize_track_processing(track, output_folder)
+
+def run_queue_worker(output_folder):
+    """
+    Worker della coda condivisa: MAX_THREADS thread prendono i lavori uno alla volta finché la coda
+    non è vuota. Un thread di heartbeat rinnova le lease dei lavori in corso; se il processo muore
+    le lease scadono e un altro worker riprende quei brani.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    load_folder_index(output_folder)
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Worker {worker_id} started on {output_folder}")
+
+    def heartbeat():
+        conn = queue_connect(output_folder)
+        try:
+            while not stop.wait(QUEUE_LEASE_SECONDS / 3):
+                conn.execute("UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'leased'",
+                             (time.time() + QUEUE_LEASE_SECONDS, worker_id))
+        finally:
+            conn.close()
+
+    def worker_loop():
+        conn = queue_connect(output_folder)
+        try:
+            while True:
+                job = claim_job(conn, worker_id)
+                if job is None:
+                    if not queue_has_pending(conn):
                         return
+                    time.sleep(QUEUE_POLL_SECONDS)  # altri worker stanno ancora lavorando: una lease potrebbe scadere
+                    continue
+                job_key, track = job
+                try:
+                    success = process_queue_job(track, output_folder)
+                except Exception as e:
+                    log_error(f"Error processing queued track {track['name']}: {e}", output_folder)
+                    success = False
+                finish_job(conn, job_key, worker_id, success)
+        finally:
+            conn.close()
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    hold_folder_activity(output_folder)  # i download in corso non vanno ripuliti da un'altra esecuzione
+    try:
+        threads = [threading.Thread(target=worker_loop) for _ in range(max_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        release_folder_activity(output_folder)
+    stop.set()
+    heartbeat_thread.join()
+
+    phase4_verification(output_folder)
+    save_folder_index(output_folder)
+    save_search_cache()
+    write_metrics()
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Worker {worker_id} finished: the queue is empty.")
+
+#si occupa del comando queue
+def queue_download(spotify_url, output_folder, processes):
+    """
+    Mette in coda i brani di un link Spotify e avvia processes worker locali sulla stessa cartella.
+    Altri container che montano la stessa cartella possono unirsi con: python MultiThreadsSpotify.py worker <cartella>
+    Con processes=0 i brani vengono solo messi in coda. Ritorna il codice di uscita.
+    """
+    if "playlist" in spotify_url:
+        tracks = get_spotify_playlist_tracks(spotify_url, 1)
+    elif "album" in spotify_url:
+        tracks = get_spotify_album_tracks(spotify_url)
+    elif "track" in spotify_url:
+        tracks = get_spotify_single_track(spotify_url)
+    else:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Unsupported Spotify URL.")
+        return EXIT_USAGE
+    os.makedirs(output_folder, exist_ok=True)
+    added = enqueue_tracks(output_folder, tracks)
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{added} tracks queued in {output_folder}." + (f" Starting {processes} workers..." if processes else ""))
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "worker", output_folder]) for _ in range(processes)]
+    results = [worker.wait() for worker in workers]
+    if workers:
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Queue complete!")
+    return EXIT_FAILURES if any(results) else EXIT_OK
 
-                    else:
-                        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f" Line {playlist_number} does not contain data in the correct format.")
-                else:
-                    print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid playlist number.")
-        except FileNotFoundError:
-            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"File Not Found.")
+#si occupa del comando update
+def update(playlist_number, policy=None):
+    """
+    Aggiorna tutte le playlist salvate (playlist_number=0) o solo quella indicata.
+    policy decide cosa fare dei file non più nella playlist (di default SYNC_POLICY).
+    Ritorna il codice di uscita: EXIT_USAGE per un numero non valido, EXIT_FAILURES se la libreria
+    è vuota o non leggibile, altrimenti EXIT_OK.
+    """
+    try:
+        spotify_urls, output_folders = load_entries()
+    except sqlite3.DatabaseError as e:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The playlist database is corrupted: {e}")
+        return EXIT_FAILURES
+    if not spotify_urls:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"No playlist has been downloaded yet.")
+        return EXIT_FAILURES
+
+    if playlist_number == 0:   #aggiorna tutte le playlist
+        valid_entries = clean_entries()
+        if shared_update:
+            update_all_shared(valid_entries, policy)
+            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Update complete!")
+            return EXIT_OK
+        for url, folder in valid_entries:
+            sync_playlist(url, folder, policy)
+            
+            print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Update complete!")
+    elif 1 <= playlist_number <= len(spotify_urls): #aggiorna la playlist playlist_number
+        url, folder = spotify_urls[playlist_number - 1], output_folders[playlist_number - 1]
+        playlist_name = sync_playlist(url, folder, policy) #update
+        print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{playlist_name} is now updated") #stampa il nome
+    else:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid playlist number.")
+        return EXIT_USAGE
+    return EXIT_OK
 
 #si occupa del comando addmeta
 def addmeta():
@@ -796,54 +3189,361 @@ def settings():
         preferred_quality = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Enter PREFERRED_QUALITY: ")
         os.environ['SPOTIFY_CLIENT_ID'] = spotify_client_id
         os.environ['SPOTIFY_CLIENT_SECRET'] = spotify_client_secret
-        os.environ['MAX_THREADS'] = max_threads
-        os.environ['PREFERRED_QUALITY'] = preferred_quality
+        # Un valore vuoto o non valido non viene applicato: resta quello precedente
+        if max_threads.strip().isdigit() and int(max_threads) > 0:
+            os.environ['MAX_THREADS'] = max_threads.strip()
+        else:
+            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Invalid MAX_THREADS '{max_threads}', keeping {os.getenv('MAX_THREADS', '4')}.")
+        if preferred_quality.strip():
+            os.environ['PREFERRED_QUALITY'] = preferred_quality.strip()
+        reset_spotify_client()
+        apply_thread_settings()
     else:
         clear_terminal()
         return
 
 def GetList():
-    result = has_content(DATA_FILE)
-    if result == 1:
-    ##stampa la lista con i nomi
-        auth_manager = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret)
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-
-        links = []
+    """
+    Stampa le playlist salvate leggendo i nomi dalla libreria, senza richieste a Spotify.
+    Solo le voci importate da un vecchio data.dat, che non hanno ancora un nome, vengono chieste una volta.
+    Ritorna EXIT_FAILURES se non c'è nessuna playlist o la libreria non è leggibile, altrimenti EXIT_OK.
+    """
+    try:
+        conn = library_connect()
+        rows = conn.execute("SELECT id, playlist_id, name FROM playlists ORDER BY id").fetchall()
+    except sqlite3.DatabaseError as e:
+        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The playlist database is corrupted: {e}")
+        return EXIT_FAILURES
+    if not rows:
+        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"No playlist has been downloaded yet.")
+        return EXIT_FAILURES
+
+    names = {row_id: name for row_id, _, name in rows}
+    missing = [(row_id, playlist_id) for row_id, playlist_id, name in rows if name is None]
+    if missing:
+        infos = fetch_playlists_info([playlist_id for _, playlist_id in missing], "name")
+        found = [(info['name'], row_id) for (row_id, _), info in zip(missing, infos) if info]
+        conn.executemany("UPDATE playlists SET name = ? WHERE id = ?", found)
+        names.update((row_id, name) for name, row_id in found)
+
+    for ID, (row_id, _, _) in enumerate(rows, 1):
+        playlist_name = names[row_id] or "Unavailable playlist"
+        print(Fore.GREEN + Style.BRIGHT + Style.RESET_ALL + f"{ID}: {playlist_name}" + Style.RESET_ALL)
+    return EXIT_OK
+
+#Demone locale: tiene caldi client Spotify, istanze yt-dlp e cache, ed esegue i lavori ricevuti via HTTP
+def daemon_submit(job):
+    """Valida e mette in coda un lavoro; ritorna il record del lavoro o solleva ValueError."""
+    job_type = job.get("type", "download")
+    if job_type == "download":
+        if not job.get("url"):
+            raise ValueError("download jobs need 'url'")
+        folder = job.get("folder") or "/app/downloads"
+    elif job_type == "update":
+        folder = None
+        if job.get("number") is not None and not isinstance(job["number"], int):
+            raise ValueError("'number' must be an integer")
+    else:
+        raise ValueError(f"unknown job type '{job_type}'")
+    priority = int(job.get("priority", 0))
+    job_id = next(daemon_ids)
+    record = {
+        "id": job_id,
+        "type": job_type,
+        "url": job.get("url"),
+        "folder": folder,
+        "number": job.get("number"),
+        "save": bool(job.get("save", True)),
+        "priority": priority,
+        "status": "queued",
+        "submitted": time.time(),
+        "started": None,
+        "finished": None,
+        "error": None,
+        "progress": {"lock": threading.Lock(), "total": 0, "processed": 0, "completed": 0},
+    }
+    with daemon_lock:
+        daemon_jobs[job_id] = record
+    daemon_queue.put((-priority, job_id))  # priorità più alta = estratto prima; a parità, in ordine di arrivo
+    return record
+
+def daemon_job_view(record):
+    """Copia del record serializzabile in JSON (senza il lock dell'avanzamento)."""
+    view = {key: value for key, value in record.items() if key != "progress"}
+    view["progress"] = {key: value for key, value in record["progress"].items() if key != "lock"}
+    return view
+
+def daemon_worker():
+    """Esegue i lavori in ordine di priorità, uno alla volta per worker."""
+    while True:
+        _, job_id = daemon_queue.get()
+        with daemon_lock:
+            record = daemon_jobs[job_id]
+            record["status"] = "running"
+            record["started"] = time.time()
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as file:
-                for line in file:
-                    parts = line.strip().split()  # Divide la riga in base agli spazi
-                    if parts:  # Verifica che la riga non sia vuota
-                        links.append(parts[0])  # Il link è il primo elemento della riga
-        except FileNotFoundError:
-            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"File Not Found.")
-            return
+            if record["type"] == "download":
+                ok = spotifydl(record["url"], record["folder"], 1 if record["save"] else 0, progress=record["progress"])
+                status = "done" if ok is not False else "failed"
+            else:
+                status = "done" if update(record["number"] or 0) == EXIT_OK else "failed"
+        except Exception as e:
+            status = "failed"
+            with daemon_lock:
+                record["error"] = str(e)
+            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Job {job_id} failed: {e}")
+        with daemon_lock:
+            record["status"] = status
+            record["finished"] = time.time()
+
+def daemon_token():
+    """Legge il token del demone da ~/.SpotifyDl, creandolo (permessi 600) se non esiste."""
+    try:
+        with open(DAEMON_TOKEN_FILE, "r", encoding="utf-8") as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except OSError:
+        pass
+    ensure_config_directory()
+    token = secrets.token_urlsafe(32)
+    fd = os.open(DAEMON_TOKEN_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    return token
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    """
+    API del demone: POST /jobs per inviare un lavoro, GET /jobs e GET /jobs/<id> per lo stato.
+    Ogni richiesta deve avere "Authorization: Bearer <token>" (il token è in ~/.SpotifyDl/.daemon_token):
+    così né gli altri utenti della macchina né una pagina web aperta nel browser possono inviare lavori.
+    """
+    token = None  # impostato da run_daemon
 
-        ID = 1
-        for link in links:
+    def authorized(self):
+        header = self.headers.get("Authorization", "")
+        if header.startswith("Bearer ") and secrets.compare_digest(header[7:].strip(), self.token or ""):
+            return True
+        self.send_json(401, {"error": "missing or invalid token"})
+        return False
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-            if "playlist" in link:
-                playlist_id = link.split("/")[-1].split("?")[0]
+    def do_GET(self):
+        if not self.authorized():
+            return
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        with daemon_lock:
+            if parts == ["jobs"]:
+                return self.send_json(200, [daemon_job_view(record) for record in daemon_jobs.values()])
+            if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit() and int(parts[1]) in daemon_jobs:
+                return self.send_json(200, daemon_job_view(daemon_jobs[int(parts[1])]))
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.split("?")[0].rstrip("/") != "/jobs":
+            return self.send_json(404, {"error": "not found"})
+        # Solo JSON: un form o un text/plain inviato da un browser viene rifiutato prima di leggerlo
+        if self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+            return self.send_json(415, {"error": "Content-Type must be application/json"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(job, dict):
+                raise ValueError("the request body must be a JSON object")
+            record = daemon_submit(job)
+        except (ValueError, TypeError) as e:
+            return self.send_json(400, {"error": str(e)})
+        with daemon_lock:
+            self.send_json(202, daemon_job_view(record))
+
+    def log_message(self, format, *args):
+        pass  # le richieste non intasano l'output del demone
+
+def run_daemon(port):
+    """Avvia il demone sull'interfaccia locale e resta in ascolto finché non viene interrotto."""
+    get_spotify_client()  # token e connessioni pronti prima del primo lavoro
+    load_search_cache()
+    DaemonHandler.token = daemon_token()
+    for _ in range(daemon_concurrent_jobs):
+        threading.Thread(target=daemon_worker, daemon=True).start()
+    server = ThreadingHTTPServer(("127.0.0.1", port), DaemonHandler)
+    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Daemon listening on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        save_search_cache()
+
+def daemon_request(port, method, path, data=None):
+    """Invia una richiesta al demone locale e ritorna la risposta JSON."""
+    body = json.dumps(data).encode("utf-8") if data is not None else None
+    request = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=body, method=method,
+                                     headers={"Content-Type": "application/json",
+                                              "Authorization": f"Bearer {daemon_token()}"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read())
+
+# === MODALITÀ NON INTERATTIVA ===
+def build_parser():
+    """Sottocomandi per l'uso da script e cron; senza argomenti parte il prompt interattivo."""
+    parser = argparse.ArgumentParser(
+        prog="MultiThreadsSpotify.py",
+        description="Download Spotify playlists, albums and tracks as MP3 files. Run without a command for the interactive prompt.",
+        epilog="Exit codes: 0 = success, 1 = some tracks failed (see log.txt), 2 = invalid arguments, 3 = missing .env or FFmpeg.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True, metavar="command")
+
+    download_parser = commands.add_parser("download", help="download one or more Spotify links")
+    download_parser.add_argument("urls", nargs="*", metavar="URL", help="Spotify playlist, album or track links")
+    download_parser.add_argument("-f", "--file", help="read links from a file, one per line ('-' for stdin)")
+    download_parser.add_argument("-o", "--out", required=True, metavar="DIR", help="destination folder")
+    download_parser.add_argument("--no-save", action="store_true", help="do not add playlists to the list used by update")
+
+    update_parser = commands.add_parser("update", help="update saved playlists")
+    update_parser.add_argument("number", nargs="?", type=int, help="playlist number from 'list'")
+    update_parser.add_argument("--all", action="store_true", help="update every saved playlist (default)")
+    update_parser.add_argument("--policy", choices=("keep", "delete", "trash"),
+                               help="what to do with files no longer in the playlist (default: SYNC_POLICY)")
+
+    commands.add_parser("list", help="show the saved playlists")
+
+    plan_parser = commands.add_parser("plan", help="print the sync plan of a saved playlist as JSON")
+    plan_parser.add_argument("number", type=int, help="playlist number from 'list'")
+    plan_parser.add_argument("--apply", action="store_true", help="apply the plan after printing it")
+    plan_parser.add_argument("--policy", choices=("keep", "delete", "trash"),
+                             help="with --apply: what to do with files no longer in the playlist (default: SYNC_POLICY)")
+
+    verify_parser = commands.add_parser("verify", help="check the metadata of every file in a folder")
+    verify_parser.add_argument("folder")
+
+    commands.add_parser("dedup", help="fold identical files into the track store")
+
+    retry_parser = commands.add_parser("retry-failed", help="download again only the tracks that failed")
+    retry_parser.add_argument("folders", nargs="*", metavar="FOLDER", help="folders to retry (default: the saved playlists)")
+    retry_parser.add_argument("--force", action="store_true", help="ignore the waiting time between attempts")
+
+    queue_parser = commands.add_parser("queue", help="put a Spotify link in the shared job queue of a folder and process it")
+    queue_parser.add_argument("url", metavar="URL", help="Spotify playlist, album or track link")
+    queue_parser.add_argument("-o", "--out", required=True, metavar="DIR", help="destination folder (holds the queue)")
+    queue_parser.add_argument("--processes", type=int, default=worker_processes, metavar="N",
+                              help="local worker processes to start (default: WORKER_PROCESSES; 0 = only queue)")
+
+    worker_parser = commands.add_parser("worker", help="process the shared job queue of a folder")
+    worker_parser.add_argument("folder")
+
+    daemon_parser = commands.add_parser("daemon", help="run a local job server with warm worker pools")
+    daemon_parser.add_argument("--port", type=int, default=daemon_port)
+
+    submit_parser = commands.add_parser("submit", help="send a download or update job to the running daemon")
+    submit_parser.add_argument("urls", nargs="*", metavar="URL", help="Spotify links to download (none = update)")
+    submit_parser.add_argument("-o", "--out", metavar="DIR", help="destination folder for downloads")
+    submit_parser.add_argument("--update", type=int, nargs="?", const=0, metavar="N", help="update playlist N (or all)")
+    submit_parser.add_argument("--priority", type=int, default=0, help="higher runs first (default: 0)")
+    submit_parser.add_argument("--port", type=int, default=daemon_port)
+
+    status_parser = commands.add_parser("status", help="show the jobs of the running daemon")
+    status_parser.add_argument("job", nargs="?", type=int, help="job id (default: all jobs)")
+    status_parser.add_argument("--port", type=int, default=daemon_port)
+    return parser
+
+def read_url_file(path):
+    """Legge i link da un file (o da stdin con '-'), saltando righe vuote e commenti."""
+    stream = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        return [line.strip() for line in stream if line.strip() and not line.strip().startswith("#")]
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+def cli(argv):
+    """Esegue un sottocomando senza prompt e ritorna il codice di uscita."""
+    global headless
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    headless = True
+    if not load_config(interactive=False):
+        return EXIT_CONFIG_ERROR
+    if args.command in ("download", "update", "queue", "worker", "daemon", "retry-failed"):
+        check_ffmpeg()
+    errors_before = error_count
+
+    if args.command == "download":
+        urls = list(args.urls)
+        if args.file:
+            try:
+                urls.extend(read_url_file(args.file))
+            except OSError as e:
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Cannot read {args.file}: {e}")
+                return EXIT_USAGE
+        if not urls:
+            parser.error("download needs at least one URL or --file")
+        results = [spotifydl(url, args.out, 0 if args.no_save else 1) for url in urls]
+        if not all(results):
+            return EXIT_FAILURES
+    elif args.command == "update":
+        if args.all and args.number is not None:
+            parser.error("use either a playlist number or --all")
+        status = update(args.number or 0, args.policy)
+        if status != EXIT_OK:
+            return status
+    elif args.command == "list":
+        status = GetList()
+        if status != EXIT_OK:
+            return status
+    elif args.command == "plan":
+        if args.policy and not args.apply:
+            parser.error("--policy needs --apply")
+        status = show_sync_plan(args.number, args.apply, args.policy)
+        if status != EXIT_OK:
+            return status
+    elif args.command == "verify":
+        verify_folder(args.folder)
+    elif args.command == "dedup":
+        dedup_library()
+    elif args.command == "retry-failed":
+        if retry_failed(args.folders or None, args.force):
+            return EXIT_FAILURES
+    elif args.command == "queue":
+        if args.processes < 0:
+            parser.error("--processes must be 0 or more")
+        status = queue_download(args.url, args.out, args.processes)
+        if status != EXIT_OK:
+            return status
+    elif args.command == "worker":
+        run_queue_worker(args.folder)
+    elif args.command == "daemon":
+        run_daemon(args.port)
+    elif args.command in ("submit", "status"):
+        try:
+            if args.command == "status":
+                print(json.dumps(daemon_request(args.port, "GET", f"/jobs/{args.job}" if args.job else "/jobs"), indent=2, ensure_ascii=False))
+            elif args.update is not None or not args.urls:
+                job = daemon_request(args.port, "POST", "/jobs", {"type": "update", "number": args.update or None, "priority": args.priority})
+                print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Job {job['id']} queued.")
             else:
-                raise ValueError("Invalid playlist URL")
+                for url in args.urls:
+                    job = daemon_request(args.port, "POST", "/jobs", {"type": "download", "url": url, "folder": args.out, "priority": args.priority})
+                    print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Job {job['id']} queued: {url}")
+        except OSError as e:
+            print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Cannot reach the daemon on port {args.port}: {e}")
+            return EXIT_FAILURES
 
-            playlist_info = sp.playlist(playlist_id)
-            playlist_name = playlist_info['name']
-            print(Fore.GREEN + Style.BRIGHT + Style.RESET_ALL + f"{ID}: {playlist_name}" + Style.RESET_ALL)
-            ID += 1
-       
-        return
-    elif result == 3:
-        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"The playlist database is corrupted.")
-    elif result == 0:
-        print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"No playlist has been downloaded yet.")
-    else:
-        print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"Unexpected error.")
-    return
+    return EXIT_FAILURES if error_count > errors_before else EXIT_OK
 
 # === MAIN ===
 def main():
+    load_config(interactive=True)
     check_ffmpeg()
     print("Welcome to SpotifyDl. To see the available commands, type help")
     while True:
@@ -854,8 +3554,11 @@ def main():
             output_folder = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Enter the destination folder: ").strip()
             spotifydl(spotify_url, output_folder, 1)
             print(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Download complete!")
+            failed = len(get_failures(output_folder)) if os.path.isdir(output_folder) else 0
             log_file = os.path.join(output_folder, "log.txt")
-            if has_content(log_file) == 1:
+            if failed:
+                print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{failed} tracks could not be downloaded (see log.txt). Enter the retry-failed command to try only those tracks again.")
+            elif has_content(log_file) == 1:
                 print(Fore.YELLOW + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"An error may have occurred. Please check the log file. If there are incorrect or incomplete files, delete the file and enter the \\update command to attempt to repair the playlist. If the error persists, the track cannot be downloaded.")
         
         elif rss == "help":
@@ -866,6 +3569,11 @@ def main():
                 "list": "Show a list of the downloaded playlists",
                 "addMeta": "Add the metadata of a Spotify song to a specific file",
                 "settings": "edit the .env file",
+                "plan <Playlist Number>": "Print as JSON what an update would download, delete or keep for a playlist",
+                "queue": "Queue any item from Spotify and download it with several worker processes",
+                "verify": "Check the metadata of every file in a folder (full scan)",
+                "dedup": "Fold identical files of the saved playlists into the track store (requires TRACK_STORE)",
+                "retry-failed": "Download again only the tracks that failed in the saved playlists, once their waiting time is over",
                 "exit": "Closes the program."
                 }
 
@@ -894,10 +3602,34 @@ def main():
         elif rss == "list":
             clear_terminal()
             GetList()
+        elif rss == "queue":
+            clear_terminal()
+            spotify_url = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Enter the Spotify link: ").strip()
+            output_folder = input(Fore.GREEN + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Enter the destination folder: ").strip() or "/app/downloads"
+            queue_download(spotify_url, output_folder, worker_processes)
+        elif rss.startswith("plan"):
+            clear_terminal()
+            parts = rss.split()
+            if len(parts) == 2 and parts[1].isdigit():
+                show_sync_plan(int(parts[1]))
+            else:
+                print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + "Invalid plan command.")
+        elif rss == "verify":
+            clear_terminal()
+            verify_folder()
+        elif rss == "dedup":
+            clear_terminal()
+            dedup_library()
+        elif rss == "retry-failed":
+            clear_terminal()
+            retry_failed()
         else:
             print(Fore.RED + Style.BRIGHT + "[SpotifyDl] " + Style.RESET_ALL + f"{rss} is not a command")
 
             
 
 if __name__ == "__main__":
-    main() #si assicura sia l'utente ad aprire lo script
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))  # sottocomandi non interattivi (cron, script, container)
+    else:
+        main() #si assicura sia l'utente ad aprire lo script
@@ -0,0 +1,370 @@
+"""
+Benchmark offline di SpotifyDl: misura download, update e controllo delle playlist senza rete.
+
+Il processo principale avvia un finto server della Web API di Spotify (con token, playlist e file
+audio di prova) e, per ogni combinazione di dimensione della libreria e numero di thread, lancia un
+processo figlio che importa MultiThreadsSpotify con una HOME temporanea. Nel figlio yt-dlp usa due
+estrattori locali (ricerca e video) che puntano ai file audio del server, quindi viene eseguito il
+vero codice di ricerca, download, conversione FFmpeg, tag e rinomina.
+
+Uso:
+    python benchmark.py [--sizes 100,1000,10000] [--threads 1,4,8] [--output bench_results.json]
+                        [--baseline bench_results.json] [--tolerance 0.15]
+
+Con --baseline i tempi vengono confrontati con un'esecuzione precedente: se uno scenario è più lento
+oltre la tolleranza il programma lo segnala ed esce con codice 1.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+try:
+    import resource  # non disponibile su Windows
+except ImportError:
+    resource = None
+
+from colorama import Fore, Style, init
+
+init(autoreset=True)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_SECONDS = 3  # durata del file audio di prova
+SEARCH_RESULTS = 5  # come ytsearch5
+GROWTH = 0.1  # frazione di brani aggiunti alla playlist prima della misura di update
+ALBUMS_TRACKS = 12
+ARTISTS = 500
+
+
+def bench_print(message, color=Fore.GREEN):
+    print(color + Style.BRIGHT + "[Benchmark] " + Style.RESET_ALL + message)
+
+
+# === Finto server Spotify (processo principale) ===
+class FakeSpotifyState:
+    """Playlist sintetiche: "bench<dimensione>x<thread>" contiene <dimensione> brani deterministici."""
+
+    def __init__(self, fixture_file):
+        self.fixture = Path(fixture_file).read_bytes()
+        self.extra = {}  # playlist -> brani aggiunti con /bench/grow
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def base_size(playlist_id):
+        return int(playlist_id[len("bench"):].split("x")[0])  # gli ID Spotify sono solo alfanumerici
+
+    def playlist_size(self, playlist_id):
+        base = self.base_size(playlist_id)
+        with self.lock:
+            return base + self.extra.get(playlist_id, 0)
+
+    def grow(self, playlist_id):
+        base = self.base_size(playlist_id)
+        with self.lock:
+            self.extra[playlist_id] = self.extra.get(playlist_id, 0) + max(1, int(base * GROWTH))
+
+    @staticmethod
+    def track(playlist_id, i):
+        return {
+            "id": hashlib.md5(f"{playlist_id}:{i}".encode()).hexdigest()[:22],
+            "name": f"Track {i} {playlist_id}",
+            "track_number": i % ALBUMS_TRACKS + 1,
+            "duration_ms": FIXTURE_SECONDS * 1000,
+            "external_ids": {"isrc": f"BENCH{i:07d}"},
+            "artists": [{"name": f"Artist {i % ARTISTS}"}],
+            "album": {"name": f"Album {i // ALBUMS_TRACKS}", "release_date": "2020-01-01"},
+        }
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    state = None  # impostato da start_fake_server
+
+    def log_message(self, format, *args):
+        pass  # niente log per ogni richiesta
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        if path == "/api/token":
+            self.send_json({"access_token": "offline-token", "token_type": "Bearer", "expires_in": 3600})
+        elif path.startswith("/bench/grow/"):
+            self.state.grow(path.rsplit("/", 1)[-1])
+            self.send_json({"ok": True})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        query = parse_qs(url.query)
+        if parts[:1] == ["audio"]:
+            body = self.state.fixture
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/webm")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif parts[:2] == ["v1", "playlists"] and len(parts) == 3:
+            playlist_id = parts[2]
+            total = self.state.playlist_size(playlist_id)
+            self.send_json({"id": playlist_id, "name": playlist_id, "snapshot_id": f"{playlist_id}-{total}",
+                            "tracks": {"total": total}})
+        elif parts[:2] == ["v1", "playlists"] and len(parts) == 4 and parts[3] in ("tracks", "items"):
+            playlist_id = parts[2]
+            total = self.state.playlist_size(playlist_id)
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["100"])[0])
+            items = [{"track": FakeSpotifyState.track(playlist_id, i)} for i in range(offset, min(total, offset + limit))]
+            self.send_json({"total": total, "offset": offset, "limit": limit, "items": items})
+        else:
+            self.send_json({"error": {"status": 404, "message": "not found"}}, 404)
+
+
+def start_fake_server(fixture_file):
+    """Avvia il server su una porta libera di 127.0.0.1 e ne restituisce l'URL base."""
+    FakeSpotifyHandler.state = FakeSpotifyState(fixture_file)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeSpotifyHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def make_fixture(folder):
+    """Genera con FFmpeg qualche secondo di silenzio in Opus/WebM, come lo stream audio di YouTube."""
+    fixture = os.path.join(folder, "fixture.webm")
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi", "-i", "anullsrc=r=48000:cl=stereo",
+                    "-t", str(FIXTURE_SECONDS), "-c:a", "libopus", "-b:a", "128k", fixture], check=True)
+    return fixture
+
+
+# === Processo figlio: esegue gli scenari con MultiThreadsSpotify ===
+def install_offline_ytdlp(base_url):
+    """Sostituisce yt_dlp.YoutubeDL con una versione che conosce solo gli estrattori locali."""
+    import yt_dlp
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class OfflineVideoIE(InfoExtractor):
+        IE_NAME = "offline:video"
+        _VALID_URL = r"offline:(?P<id>[0-9a-f]+)"
+
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            return {
+                "id": video_id,
+                "title": f"Offline {video_id}",
+                "duration": FIXTURE_SECONDS,
+                "formats": [{"format_id": "251", "url": f"{base_url}/audio/{video_id}.webm", "ext": "webm",
+                             "acodec": "opus", "vcodec": "none", "abr": 128}],
+            }
+
+    class OfflineSearchIE(InfoExtractor):
+        IE_NAME = "offline:search"
+        _VALID_URL = r"(?!offline:)(?P<query>.+)"
+
+        def _real_extract(self, url):
+            query = self._match_valid_url(url).group("query")
+            digest = hashlib.md5(query.encode("utf-8")).hexdigest()[:12]
+            # Come i risultati di ytsearch: titolo, durata e canale sono già nella pagina dei risultati
+            entries = [self.url_result(f"offline:{digest}{k}", OfflineVideoIE, f"{digest}{k}", query,
+                                       duration=FIXTURE_SECONDS, channel="Offline - Topic") for k in range(SEARCH_RESULTS)]
+            return self.playlist_result(entries, digest, query)
+
+    class OfflineYoutubeDL(yt_dlp.YoutubeDL):
+        def __init__(self, params=None, auto_init=True):
+            super().__init__(params, auto_init=False)
+            self.add_info_extractor(OfflineVideoIE())
+            self.add_info_extractor(OfflineSearchIE())
+
+    yt_dlp.YoutubeDL = OfflineYoutubeDL
+
+
+def peak_rss_mb():
+    """Picco di memoria residente del processo e dei figli terminati (FFmpeg), in MB."""
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # macOS usa byte, Linux KB
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024 * 1024)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / (1024 * 1024)
+    return round(own, 1), round(children, 1)
+
+
+def count_audio_files(folder, spotify):
+    return sum(1 for file in Path(folder).iterdir() if spotify.is_audio_file(file)) if os.path.isdir(folder) else 0
+
+
+def run_scenarios(size, threads, base_url, result_file, verbose):
+    """Esegue download, update e check su una playlist di size brani e scrive i risultati in JSON."""
+    sys.path.insert(0, SCRIPT_DIR)
+    import MultiThreadsSpotify as spotify
+    from spotipy.oauth2 import SpotifyClientCredentials
+
+    spotify.headless = True
+    install_offline_ytdlp(base_url)
+    SpotifyClientCredentials.OAUTH_TOKEN_URL = f"{base_url}/api/token"
+    spotify.get_spotify_client().prefix = f"{base_url}/v1/"
+
+    playlist_id = f"bench{size}x{threads}"
+    url = f"https://open.spotify.com/playlist/{playlist_id}"
+    folder = os.path.join(os.path.expanduser("~"), "library")
+    results = []
+    # Un solo sink per tutto il processo: le istanze YoutubeDL nei pool tengono il riferimento allo stdout
+    sink = sys.stdout if verbose else open(os.devnull, "w")
+
+    def measure(name, func):
+        before = count_audio_files(folder, spotify)
+        spotify.reset_metrics()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sink):
+            func()
+        wall = time.perf_counter() - started
+        summary = spotify.metrics_summary()
+        processed = count_audio_files(folder, spotify) - before if name != "check" else size
+        rss, children_rss = peak_rss_mb()
+        results.append({
+            "scenario": name, "size": size, "threads": threads, "wall_seconds": round(wall, 3),
+            "files_per_second": round(processed / wall, 2) if wall else None, "files": processed,
+            "peak_rss_mb": rss, "peak_children_rss_mb": children_rss,
+            "stages": {stage: {"count": entry["count"], "seconds": round(entry["seconds"], 3),
+                               "avg_seconds": round(entry["avg_seconds"], 4), "failures": entry["failures"]}
+                       for stage, entry in summary["stages"].items()},
+            "failures": summary["failures"],
+        })
+
+    def grow_and_update():
+        urlopen(Request(f"{base_url}/bench/grow/{playlist_id}", data=b"", method="POST")).read()
+        spotify.update(0)
+
+    measure("download", lambda: spotify.spotifydl(url, folder, 1))
+    measure("update", grow_and_update)
+    measure("check", lambda: spotify.check_playlist_files(url, folder, policy="keep"))
+
+    with open(result_file, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+
+
+# === Processo principale: orchestrazione, tabella e confronto con una baseline ===
+def run_child(size, threads, base_url, work_dir, verbose):
+    """Lancia un processo figlio isolato (HOME temporanea, nessuna configurazione dell'utente)."""
+    home = tempfile.mkdtemp(prefix=f"home-{size}-{threads}-", dir=work_dir)
+    os.makedirs(os.path.join(home, ".SpotifyDl"))
+    result_file = os.path.join(home, "result.json")
+    env = dict(os.environ, HOME=home, USERPROFILE=home, MAX_THREADS=str(threads),
+               SPOTIFY_CLIENT_ID="offline", SPOTIFY_CLIENT_SECRET="offline")
+    # Il finto server non limita le richieste: si misura il programma, non il controllo del rate
+    env.setdefault("SPOTIFY_RATE", "1000")
+    env.setdefault("YOUTUBE_RATE", "1000")
+    for key in ("SEARCH_THREADS", "DOWNLOAD_THREADS", "TRACK_STORE", "METRICS_TEXTFILE", "METRICS_FILE"):
+        env.pop(key, None)  # i valori del .env dell'utente non devono falsare la misura
+    command = [sys.executable, os.path.abspath(__file__), "--child", str(size), str(threads), base_url, result_file]
+    if verbose:
+        command.append("--verbose")
+    completed = subprocess.run(command, env=env, stdout=None if verbose else subprocess.DEVNULL)
+    if completed.returncode != 0 or not os.path.exists(result_file):
+        bench_print(f"Run with {size} tracks and {threads} threads failed (exit code {completed.returncode}).", Fore.RED)
+        return []
+    with open(result_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def print_table(results):
+    stages = ("spotify", "search", "download", "transcode", "tag", "rename")
+    header = f"{'scenario':<9}{'tracks':>7}{'thr':>5}{'wall s':>9}{'files/s':>9}{'RSS MB':>8}" + "".join(f"{stage:>10}" for stage in stages)
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        row = (f"{result['scenario']:<9}{result['size']:>7}{result['threads']:>5}{result['wall_seconds']:>9.2f}"
+               f"{result['files_per_second'] or 0:>9.1f}{result['peak_rss_mb'] or 0:>8.0f}")
+        row += "".join(f"{result['stages'].get(stage, {}).get('seconds', 0):>10.2f}" for stage in stages)
+        print(row)
+    print("Stage columns are the total seconds spent in each stage, summed over all threads.")
+
+
+def compare_with_baseline(results, baseline_file, tolerance):
+    """Segnala gli scenari più lenti della baseline oltre la tolleranza. Ritorna il numero di regressioni."""
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {(r["scenario"], r["size"], r["threads"]): r for r in json.load(f)}
+    regressions = 0
+    for result in results:
+        previous = baseline.get((result["scenario"], result["size"], result["threads"]))
+        if not previous or not previous["wall_seconds"]:
+            continue
+        change = result["wall_seconds"] / previous["wall_seconds"] - 1
+        if change > tolerance:
+            regressions += 1
+            bench_print(f"Regression: {result['scenario']} with {result['size']} tracks and {result['threads']} threads "
+                        f"took {result['wall_seconds']:.2f}s (baseline {previous['wall_seconds']:.2f}s, +{change:.0%}).", Fore.RED)
+    if not regressions:
+        bench_print(f"No regressions above {tolerance:.0%} compared with {baseline_file}.")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for SpotifyDl (no network needed).")
+    parser.add_argument("--sizes", default="100,1000,10000", help="comma separated playlist sizes (default: 100,1000,10000)")
+    parser.add_argument("--threads", default="1,4,8", help="comma separated MAX_THREADS values to sweep (default: 1,4,8)")
+    parser.add_argument("--output", default="bench_results.json", help="where to save the results as JSON")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed slowdown before a regression is reported (default: 0.15)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary libraries after the run")
+    parser.add_argument("--verbose", action="store_true", help="show the program output")
+    parser.add_argument("--child", nargs=4, metavar=("SIZE", "THREADS", "BASE_URL", "RESULT_FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        size, threads, base_url, result_file = args.child
+        run_scenarios(int(size), int(threads), base_url, result_file, args.verbose)
+        return 0
+
+    if shutil.which("ffmpeg") is None:
+        bench_print("FFmpeg is required to build the audio fixture and to convert the tracks.", Fore.RED)
+        return 3
+    sizes = [int(value) for value in args.sizes.split(",") if value.strip()]
+    thread_counts = [int(value) for value in args.threads.split(",") if value.strip()]
+
+    work_dir = tempfile.mkdtemp(prefix="spotifydl-bench-")
+    results = []
+    try:
+        server, base_url = start_fake_server(make_fixture(work_dir))
+        bench_print(f"Fake Spotify and YouTube server listening on {base_url}")
+        for size in sizes:
+            for threads in thread_counts:
+                bench_print(f"Running {size} tracks with {threads} threads...")
+                results.extend(run_child(size, threads, base_url, work_dir, args.verbose))
+        server.shutdown()
+    finally:
+        if args.keep:
+            bench_print(f"Temporary libraries kept in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    bench_print(f"Results saved to {args.output}")
+    if args.baseline:
+        return 1 if compare_with_baseline(results, args.baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())